@@ -1,10 +1,15 @@
-import copy
 import json
 import os
 import logging
+import time
 import uuid
 import httpx
+import hashlib
+import hmac
 import asyncio
+import functools
+from datetime import datetime
+from contextlib import asynccontextmanager
 from quart import (
     Blueprint,
     Quart,
@@ -14,37 +19,77 @@ from quart import (
     send_from_directory,
     render_template,
     current_app,
+    g,
 )
+from quart.wrappers.response import IterableBody
 
 from openai import AsyncAzureOpenAI
 from azure.identity.aio import (
     DefaultAzureCredential,
     get_bearer_token_provider
 )
+from pydantic import ValidationError
+from backend import metrics, timing
+from backend.admission import AdmissionController, AdmissionRejectedError
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.chat_request import TOKENS_PER_MESSAGE, ChatRequest
+from backend.deployment_pool import Deployment, DeploymentPool
+from backend.retry import CircuitBreaker, RetryPolicy
+from backend.response_cache import (
+    ResponseCache,
+    cached_response,
+    record_stream,
+    replay_cached_response,
+)
+from backend.prompt_cache import (
+    PromptCache,
+    MemoryPromptCacheBackend,
+    SqlitePromptCacheBackend,
+)
 from backend.security.ms_defender_utils import get_msdefender_user_json
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbservice import (
+    CosmosConversationClient,
+    decode_cursor,
+    encode_cursor,
+)
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
-    format_as_ndjson,
+    RedactingLoggerAdapter,
+    close_graph_client,
+    format_stream_as_ndjson,
+    merge_late_history_metadata,
+    estimate_tokens,
+    get_token_counter,
+    heuristic_title,
+    truncate_to_tokens,
+    with_late_history_metadata,
     format_stream_response,
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    format_pf_stream_response,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 
 cosmos_db_ready = asyncio.Event()
 
+# Title generation outlives the request when the answer fails or the client
+# goes away; the tasks are kept here until they are done
+title_tasks = set()
+
 
 def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    metrics.configure(
+        enabled=app_settings.metrics.enabled,
+        otel_enabled=app_settings.metrics.otel_enabled
+    )
     
     @app.before_serving
     async def init():
@@ -55,6 +100,62 @@ def create_app():
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+
+        app.azure_openai_credential = None
+        try:
+            if any(not deployment.key for deployment in app_settings.azure_openai.get_deployments()):
+                app.azure_openai_credential = DefaultAzureCredential()
+            app.azure_openai_pool = await init_openai_pool(
+                credential=app.azure_openai_credential
+            )
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.azure_openai_pool = None
+
+        app.response_cache = None
+        if app_settings.response_cache.enabled:
+            app.response_cache = ResponseCache(
+                maxsize=app_settings.response_cache.max_entries,
+                ttl=app_settings.response_cache.ttl
+            )
+
+        app.prompt_cache = init_prompt_cache()
+
+        app.admission = None
+        if app_settings.admission.enabled:
+            app.admission = AdmissionController(
+                max_in_flight=app_settings.admission.max_in_flight,
+                user_requests_per_minute=app_settings.admission.user_requests_per_minute,
+                user_burst=app_settings.admission.user_burst,
+                tokens_per_minute=app_settings.admission.tokens_per_minute,
+            )
+
+        app.promptflow_client = await init_promptflow_client()
+        if app.promptflow_client:
+            app.promptflow_semaphore = asyncio.Semaphore(
+                app_settings.promptflow.max_concurrent_requests
+            )
+
+    @app.after_serving
+    async def shutdown():
+        if title_tasks:
+            await asyncio.gather(*title_tasks, return_exceptions=True)
+        if getattr(app, "cosmos_conversation_client", None):
+            await app.cosmos_conversation_client.close()
+            app.cosmos_conversation_client = None
+        if getattr(app, "azure_openai_pool", None):
+            await app.azure_openai_pool.close()
+            app.azure_openai_pool = None
+        if getattr(app, "azure_openai_credential", None):
+            await app.azure_openai_credential.close()
+            app.azure_openai_credential = None
+        if getattr(app, "prompt_cache", None):
+            await app.prompt_cache.close()
+            app.prompt_cache = None
+        if getattr(app, "promptflow_client", None):
+            await app.promptflow_client.aclose()
+            app.promptflow_client = None
+        await close_graph_client()
     
     return app
 
@@ -85,6 +186,9 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+# Logs request bodies with secrets masked, serializing them only when DEBUG is on
+request_body_logger = RedactingLoggerAdapter()
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
@@ -112,8 +216,10 @@ MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "
 
 
 # Initialize Azure OpenAI Client
-async def init_openai_client():
+async def init_openai_client(credential=None, deployment=None):
     azure_openai_client = None
+    if deployment is None:
+        deployment = app_settings.azure_openai.get_deployments()[0]
     
     try:
         # API version check
@@ -126,45 +232,53 @@ async def init_openai_client():
             )
 
         # Endpoint
-        if (
-            not app_settings.azure_openai.endpoint and
-            not app_settings.azure_openai.resource
-        ):
+        if not deployment.endpoint and not deployment.resource:
             raise ValueError(
                 "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
             )
 
-        endpoint = (
-            app_settings.azure_openai.endpoint
-            if app_settings.azure_openai.endpoint
-            else f"https://{app_settings.azure_openai.resource}.openai.azure.com/"
-        )
+        endpoint = deployment.base_url
 
         # Authentication
-        aoai_api_key = app_settings.azure_openai.key
+        # The credential must stay open for as long as the client is in use so
+        # that the token provider can reuse cached tokens across requests.
+        aoai_api_key = deployment.key
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential,
-                    "https://cognitiveservices.azure.com/.default"
-                )
+            if credential is None:
+                credential = DefaultAzureCredential()
+            ad_token_provider = get_bearer_token_provider(
+                credential,
+                "https://cognitiveservices.azure.com/.default"
+            )
 
         # Deployment
-        deployment = app_settings.azure_openai.model
-        if not deployment:
+        if not (deployment.model or app_settings.azure_openai.model):
             raise ValueError("AZURE_OPENAI_MODEL is required")
 
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # Connection pool shared by every request served by this worker
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=app_settings.azure_openai.max_connections,
+                max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+                keepalive_expiry=app_settings.azure_openai.keepalive_expiry,
+            ),
+            follow_redirects=True,
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
+            # Retries and failover are done by the DeploymentPool
+            max_retries=0,
         )
 
         return azure_openai_client
@@ -174,6 +288,106 @@ async def init_openai_client():
         raise e
 
 
+async def init_openai_pool(credential=None):
+    ## One client per deployment of AZURE_OPENAI_DEPLOYMENTS, or just the
+    ## AZURE_OPENAI_ENDPOINT deployment, behind a DeploymentPool
+    deployments = []
+    for deployment_settings in app_settings.azure_openai.get_deployments():
+        client = await init_openai_client(credential=credential, deployment=deployment_settings)
+        deployments.append(Deployment(
+            client=client,
+            model=deployment_settings.model or app_settings.azure_openai.model,
+            weight=deployment_settings.weight,
+            name=f"{httpx.URL(deployment_settings.base_url).host}/{deployment_settings.model or app_settings.azure_openai.model}",
+            breaker=CircuitBreaker(
+                failure_threshold=app_settings.azure_openai.circuit_failure_threshold,
+                reset_timeout=app_settings.azure_openai.circuit_reset_timeout,
+            ),
+        ))
+
+    retry_policy = RetryPolicy(
+        max_retries=app_settings.azure_openai.max_retries,
+        base_delay=app_settings.azure_openai.retry_base_delay,
+        max_delay=app_settings.azure_openai.retry_max_delay,
+        deadline=app_settings.azure_openai.request_deadline,
+    )
+    return DeploymentPool(deployments, retry_policy, default_model=app_settings.azure_openai.model)
+
+
+async def init_promptflow_client():
+    promptflow_client = None
+    if app_settings.base_settings.use_promptflow and app_settings.promptflow:
+        # Adding timeout for scenarios where response takes longer to come back
+        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
+        promptflow_client = httpx.AsyncClient(
+            http2=app_settings.promptflow.http2,
+            timeout=float(app_settings.promptflow.response_timeout),
+            limits=httpx.Limits(
+                max_connections=app_settings.promptflow.max_connections,
+                max_keepalive_connections=app_settings.promptflow.max_keepalive_connections,
+            ),
+        )
+    else:
+        logging.debug("Promptflow not configured")
+
+    return promptflow_client
+
+
+async def get_openai_pool():
+    ## The pool is created before serving; when the startup hooks have not run
+    ## (e.g. with app.test_client()) it is created on first use instead
+    app = current_app._get_current_object()
+    azure_openai_pool = getattr(app, "azure_openai_pool", None)
+    if azure_openai_pool is None:
+        credential = getattr(app, "azure_openai_credential", None)
+        if credential is None and any(
+            not deployment.key for deployment in app_settings.azure_openai.get_deployments()
+        ):
+            credential = app.azure_openai_credential = DefaultAzureCredential()
+        azure_openai_pool = await init_openai_pool(credential=credential)
+        if getattr(app, "azure_openai_pool", None) is None:
+            app.azure_openai_pool = azure_openai_pool
+        else:
+            await azure_openai_pool.close()
+            azure_openai_pool = app.azure_openai_pool
+    return azure_openai_pool
+
+
+async def get_promptflow_client():
+    ## Same as get_openai_pool, for the Promptflow client and its semaphore
+    app = current_app._get_current_object()
+    if getattr(app, "promptflow_client", None) is None:
+        promptflow_client = await init_promptflow_client()
+        if not promptflow_client:
+            return None, None
+        if getattr(app, "promptflow_client", None) is None:
+            app.promptflow_client = promptflow_client
+            app.promptflow_semaphore = asyncio.Semaphore(
+                app_settings.promptflow.max_concurrent_requests
+            )
+        else:
+            await promptflow_client.aclose()
+    return app.promptflow_client, app.promptflow_semaphore
+
+
+def init_prompt_cache():
+    settings = app_settings.prompt_cache
+    if settings.backend == "memory":
+        backend = MemoryPromptCacheBackend(max_entries=settings.max_entries, ttl=settings.ttl)
+    elif settings.backend == "sqlite":
+        try:
+            backend = SqlitePromptCacheBackend(
+                path=settings.path, max_entries=settings.max_entries, ttl=settings.ttl
+            )
+        except Exception:
+            logging.exception("Failed to open the prompt cache, continuing without it")
+            return None
+    else:
+        return None
+
+    return PromptCache(backend)
+
+
 async def init_cosmosdb_client():
     cosmos_conversation_client = None
     if app_settings.chat_history:
@@ -195,19 +409,31 @@ async def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                conversation_write_behind_seconds=app_settings.chat_history.conversation_write_behind_seconds,
+                delete_concurrency=app_settings.chat_history.delete_concurrency,
+                list_cache_ttl=app_settings.chat_history.list_cache_ttl,
+                list_cache_size=app_settings.chat_history.list_cache_size,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
             cosmos_conversation_client = None
             raise e
+
+        ## check the indexing policy up front so history queries can rely on the composite indexes when they exist
+        try:
+            await cosmos_conversation_client.ensure()
+            if app_settings.chat_history.apply_indexing_policy:
+                await cosmos_conversation_client.apply_recommended_indexing_policy()
+        except Exception:
+            logging.exception("Failed to check the CosmosDB indexing policy")
     else:
         logging.debug("CosmosDB not configured")
 
     return cosmos_conversation_client
 
 
-def prepare_model_args(request_body, request_headers):
-    request_messages = request_body.get("messages", [])
+@timing.timed_phase("payload")
+async def prepare_model_args(chat_request: ChatRequest, request_headers):
     messages = []
     if not app_settings.datasource:
         messages = [
@@ -217,29 +443,34 @@ def prepare_model_args(request_body, request_headers):
             }
         ]
 
-    for message in request_messages:
-        if message:
-            if message["role"] == "assistant" and "context" in message:
-                context_obj = json.loads(message["context"])
-                messages.append(
-                    {
-                        "role": message["role"],
-                        "content": message["content"],
-                        "context": context_obj
-                    }
-                )
-            else:
-                messages.append(
-                    {
-                        "role": message["role"],
-                        "content": message["content"]
-                    }
-                )
+    history = chat_request.messages
+    token_budget = app_settings.azure_openai.history_token_budget
+    contexts_to_keep = app_settings.azure_openai.history_contexts_to_keep
+    if token_budget:
+        count_tokens = get_token_counter(
+            app_settings.azure_openai.tokenizer_model or app_settings.azure_openai.model
+        )
+        reserved_tokens = sum(
+            count_tokens(message["content"]) + TOKENS_PER_MESSAGE for message in messages
+        )
+        history, tokens_before, tokens_after = chat_request.trim_history(
+            token_budget,
+            count_tokens=count_tokens,
+            reserved_tokens=reserved_tokens,
+            contexts_to_keep=contexts_to_keep,
+        )
+        if tokens_after < tokens_before:
+            logging.debug(
+                "Trimmed conversation history from %d to %d tokens, %d messages kept",
+                tokens_before, tokens_after, len(history)
+            )
+
+    messages.extend(chat_request.to_openai_messages(history, contexts_to_keep))
 
     user_json = None
     if (MS_DEFENDER_ENABLED):
         authenticated_user_details = get_authenticated_user_details(request_headers)
-        conversation_id = request_body.get("conversation_id", None)
+        conversation_id = chat_request.conversation_id
         application_name = app_settings.ui.title
         user_json = get_msdefender_user_json(authenticated_user_details, request_headers, conversation_id, application_name)
 
@@ -254,113 +485,171 @@ def prepare_model_args(request_body, request_headers):
         "user": user_json
     }
 
+    if app_settings.azure_openai.seed is not None:
+        model_args["seed"] = app_settings.azure_openai.seed
+
     if app_settings.datasource:
         model_args["extra_body"] = {
             "data_sources": [
-                app_settings.datasource.construct_payload_configuration(
+                await app_settings.datasource.construct_payload_configuration(
                     request=request
                 )
             ]
         }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+    request_body_logger.debug("REQUEST BODY: %s", model_args)
 
     return model_args
 
 
-async def promptflow_request(request):
+class PromptflowBusyError(Exception):
+    status_code = 503
+
+
+@asynccontextmanager
+async def promptflow_slot(semaphore):
+    # Caps the number of in-flight Promptflow calls per worker. Requests
+    # over the cap wait up to PROMPTFLOW_QUEUE_TIMEOUT seconds for a slot
+    # instead of piling up until the gunicorn timeout.
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {app_settings.promptflow.api_key}",
-        }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
+        await asyncio.wait_for(
+            semaphore.acquire(),
+            timeout=app_settings.promptflow.queue_timeout
+        )
+    except asyncio.TimeoutError:
+        raise PromptflowBusyError(
+            "The Promptflow endpoint is busy, please try again later."
+        )
+
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def prepare_promptflow_request(request):
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {app_settings.promptflow.api_key}",
+    }
+    pf_formatted_obj = convert_to_pf_format(
+        request,
+        app_settings.promptflow.request_field_name,
+        app_settings.promptflow.response_field_name
+    )
+    # NOTE: This only support question and chat_history parameters
+    # If you need to add more parameters, you need to modify the request body
+    body = {
+        app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
+        "chat_history": pf_formatted_obj[:-1],
+    }
+    return body, headers
+
+
+async def promptflow_stream(client, semaphore, body, headers):
+    # Yields the flow outputs as they arrive. Endpoints that stream send
+    # server-sent events (or JSON lines); endpoints that don't are read as a
+    # single JSON document.
+    async with promptflow_slot(semaphore):
+        async with client.stream(
+            "POST",
+            app_settings.promptflow.endpoint,
+            json=body,
+            headers={**headers, "Accept": "text/event-stream"},
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(
+                    f"Promptflow endpoint returned {response.status_code}: {response.text}"
+                )
+
+            content_type = response.headers.get("content-type", "")
+            if "text/event-stream" not in content_type and "jsonl" not in content_type:
+                yield json.loads(await response.aread())
+                return
+
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    line = line[len("data:"):]
+                line = line.strip()
+                if not line or line.startswith(":") or line.startswith("event:"):
+                    continue
+                yield json.loads(line)
+
+
+async def promptflow_request(request, stream=False):
+    client, semaphore = await get_promptflow_client()
+    if not client:
+        raise Exception("Promptflow is not configured or not working")
+
+    if stream:
+        body, headers = prepare_promptflow_request(request)
+        chunks = promptflow_stream(client, semaphore, body, headers)
+        close_with_response(chunks.aclose)
+
+        # Wait for the first chunk so that a busy or failing endpoint is
+        # reported with an HTTP error status instead of inside the stream
+        try:
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = None
+
+        async def generate():
+            if first_chunk is not None:
+                yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+
+        return generate()
+
+    async with promptflow_slot(semaphore):
+        try:
+            body, headers = prepare_promptflow_request(request)
             response = await client.post(
                 app_settings.promptflow.endpoint,
-                json={
-                    app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
+                json=body,
                 headers=headers,
             )
-        resp = response.json()
-        resp["id"] = request["messages"][-1]["id"]
-        return resp
-    except Exception as e:
-        logging.error(f"An error occurred while making promptflow_request: {e}")
+            resp = response.json()
+            resp["id"] = request.messages[-1].id
+            return resp
+        except Exception as e:
+            logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
-async def send_chat_request(request_body, request_headers):
-    filtered_messages = []
-    messages = request_body.get("messages", [])
-    for message in messages:
-        if message.get("role") != 'tool':
-            filtered_messages.append(message)
-            
-    request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+async def send_chat_request(chat_request: ChatRequest, request_headers, model_args=None):
+    started_at = time.monotonic()
+    if model_args is None:
+        model_args = await prepare_model_args(chat_request, request_headers)
 
     try:
-        azure_openai_client = await init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
-        response = raw_response.parse()
-        apim_request_id = raw_response.headers.get("apim-request-id") 
+        azure_openai_pool = await get_openai_pool()
+        if not azure_openai_pool:
+            raise Exception("Azure OpenAI client is not configured or not working")
+        with metrics.span("send_chat_request", stream=bool(model_args.get("stream"))) as span:
+            with timing.phase("upstream"):
+                raw_response = await azure_openai_pool.create(model_args, started_at=started_at)
+            response = raw_response.parse()
+            apim_request_id = raw_response.headers.get("apim-request-id") 
+            if span is not None and apim_request_id:
+                span.set_attribute("apim_request_id", apim_request_id)
     except Exception as e:
+        metrics.CHAT_REQUEST_SECONDS.observe(time.monotonic() - started_at, outcome="error")
         logging.exception("Exception in send_chat_request")
         raise e
 
+    metrics.CHAT_REQUEST_SECONDS.observe(
+        time.monotonic() - started_at,
+        exemplar={"apim_request_id": apim_request_id} if apim_request_id else None,
+        outcome="ok"
+    )
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body, request_headers):
+async def complete_chat_request(chat_request: ChatRequest, request_headers):
     if app_settings.base_settings.use_promptflow:
-        response = await promptflow_request(request_body)
-        history_metadata = request_body.get("history_metadata", {})
+        response = await promptflow_request(chat_request)
+        history_metadata = chat_request.history_metadata
         return format_pf_non_streaming_response(
             response,
             history_metadata,
@@ -368,49 +657,370 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
-        history_metadata = request_body.get("history_metadata", {})
-        return format_non_streaming_response(response, history_metadata, apim_request_id)
-
-
-async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
-    history_metadata = request_body.get("history_metadata", {})
+        history_metadata = chat_request.history_metadata
+        model_args = await prepare_model_args(chat_request, request_headers)
+        cached, cache_keys = await get_cached_response(model_args)
+        if cached:
+            return cached_response(cached, history_metadata)
+
+        response, apim_request_id = await send_chat_request(chat_request, request_headers, model_args)
+        if getattr(response, "usage", None):
+            metrics.CHAT_COMPLETION_TOKENS.inc(response.usage.completion_tokens, stream="false")
+        result = format_non_streaming_response(response, history_metadata, apim_request_id)
+        await cache_response(current_app, cache_keys, result)
+        return result
+
+
+async def stream_chat_request(chat_request: ChatRequest, request_headers):
+    history_metadata = chat_request.history_metadata
+    model_args = await prepare_model_args(chat_request, request_headers)
+    cached, cache_keys = await get_cached_response(model_args)
+    if cached:
+        return replay_cached_response(cached, history_metadata)
+
+    sent_at = time.monotonic()
+    response, apim_request_id = await send_chat_request(chat_request, request_headers, model_args)
+    close_with_response(response.close)
+    # The stream is consumed after the request context is gone
+    timer = timing.current()
     
     async def generate():
+        if not metrics.is_enabled() and timer is None:
+            async for completionChunk in response:
+                yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+            return
+
+        ## time to first token, generation speed and stream duration; each
+        ## content chunk of the stream is one token
+        first_token_at = None
+        tokens = 0
         async for completionChunk in response:
+            if completionChunk.choices and getattr(completionChunk.choices[0].delta, "content", None):
+                tokens += 1
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                    metrics.CHAT_TIME_TO_FIRST_TOKEN_SECONDS.observe(
+                        first_token_at - sent_at,
+                        exemplar={"apim_request_id": apim_request_id} if apim_request_id else None
+                    )
+                    if timer:
+                        timer.mark("ttft", since=sent_at)
             yield format_stream_response(completionChunk, history_metadata, apim_request_id)
 
+        finished_at = time.monotonic()
+        if timer:
+            timer.mark("stream", since=sent_at)
+        metrics.CHAT_STREAM_SECONDS.observe(finished_at - sent_at)
+        metrics.CHAT_COMPLETION_TOKENS.inc(tokens, stream="true")
+        if tokens > 1 and finished_at > first_token_at:
+            metrics.CHAT_TOKENS_PER_SECOND.observe((tokens - 1) / (finished_at - first_token_at))
+
+    if any(cache_keys):
+        # The stream is consumed after the request context is gone
+        app = current_app._get_current_object()
+        return record_stream(generate(), lambda result: cache_response(app, cache_keys, result))
+    return generate()
+
+
+@timing.timed_phase("cache")
+async def get_cached_response(model_args):
+    ## Exact-match prompt cache first, then the response cache of first questions.
+    ## Returns the cached answer, or the keys to cache the new answer under.
+    prompt_cache = getattr(current_app, "prompt_cache", None)
+    prompt_cache_key = prompt_cache.key(model_args) if prompt_cache else None
+    if prompt_cache_key:
+        cached = await prompt_cache.get(prompt_cache_key)
+        metrics.PROMPT_CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+        if cached:
+            logging.debug("Answering from the prompt cache")
+            return cached, (None, None)
+
+    response_cache = getattr(current_app, "response_cache", None)
+    response_cache_key = response_cache.key(model_args) if response_cache is not None else None
+    if response_cache_key:
+        cached = response_cache.get(response_cache_key)
+        if cached:
+            logging.debug("Answering from the response cache")
+            return cached, (None, None)
+
+    return None, (prompt_cache_key, response_cache_key)
+
+
+async def cache_response(app, cache_keys, result):
+    prompt_cache_key, response_cache_key = cache_keys
+    if prompt_cache_key:
+        await app.prompt_cache.set(prompt_cache_key, result)
+    if response_cache_key:
+        app.response_cache.set(response_cache_key, result)
+
+
+async def stream_promptflow_request(chat_request: ChatRequest):
+    chunks = await promptflow_request(chat_request, stream=True)
+    history_metadata = chat_request.history_metadata
+    message_uuid = chat_request.messages[-1].id
+
+    async def generate():
+        async for chunk in chunks:
+            yield format_pf_stream_response(
+                chunk,
+                history_metadata,
+                app_settings.promptflow.response_field_name,
+                app_settings.promptflow.citations_field_name,
+                message_uuid
+            )
+
     return generate()
 
 
-async def conversation_internal(request_body, request_headers):
+async def conversation_internal(chat_request: ChatRequest, request_headers, late_history_metadata=None):
+    ## late_history_metadata: optional task resolving to extra history_metadata fields (e.g. a generated title)
+    ## that are attached to the last event of the response instead of delaying its start
+    timer = timing.current()
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+        if app_settings.base_settings.use_promptflow and app_settings.promptflow.stream:
+            result = await stream_promptflow_request(chat_request)
+            if late_history_metadata:
+                result = with_late_history_metadata(
+                    result, late_history_metadata, app_settings.chat_history.title_timeout
+                )
+            if timer:
+                result = timing.with_timing_trailer(result, timer)
+            response = await make_response(format_stream_as_ndjson(
+                result,
+                app_settings.base_settings.stream_coalesce_window_ms,
+                app_settings.base_settings.stream_coalesce_max_bytes
+            ))
+            response.timeout = None
+            response.mimetype = "application/json-lines"
+            response.response.iter = _ClosingBody(response.response.iter, g.get("stream_closers", []))
+            return response
+        elif app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
+            result = await stream_chat_request(chat_request, request_headers)
+            if late_history_metadata:
+                result = with_late_history_metadata(
+                    result, late_history_metadata, app_settings.chat_history.title_timeout
+                )
+            if timer:
+                result = timing.with_timing_trailer(result, timer)
+            response = await make_response(format_stream_as_ndjson(
+                result,
+                app_settings.base_settings.stream_coalesce_window_ms,
+                app_settings.base_settings.stream_coalesce_max_bytes
+            ))
             response.timeout = None
             response.mimetype = "application/json-lines"
+            response.response.iter = _ClosingBody(response.response.iter, g.get("stream_closers", []))
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
+            result = await complete_chat_request(chat_request, request_headers)
+            if late_history_metadata:
+                result = await merge_late_history_metadata(
+                    result, late_history_metadata, app_settings.chat_history.title_timeout
+                )
+            if timer and timer.debug:
+                result = {**result, "debug_trace": timer.trace()}
             return jsonify(result)
 
     except Exception as ex:
         logging.exception(ex)
         if hasattr(ex, "status_code"):
-            return jsonify({"error": str(ex)}), ex.status_code
+            response = jsonify({"error": str(ex)})
+            response.status_code = ex.status_code
+            # Pass on when the client should retry
+            upstream_response = getattr(ex, "response", None)
+            if hasattr(ex, "retry_after_header"):
+                response.headers["Retry-After"] = ex.retry_after_header
+            elif ex.status_code == 429 and upstream_response is not None:
+                retry_after = upstream_response.headers.get("retry-after")
+                if retry_after:
+                    response.headers["Retry-After"] = retry_after
+            return response
         else:
             return jsonify({"error": str(ex)}), 500
 
 
+class _ReleasingBody:
+    ## Response body iterator that calls release once the body is exhausted
+    ## or closed, including when it is closed before it was started
+    def __init__(self, body, release):
+        self._body = body
+        self._release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._body.__anext__()
+        except BaseException:
+            self._release()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._body.aclose()
+        finally:
+            self._release()
+
+
+def close_with_response(close):
+    ## Register a coroutine function releasing an upstream stream (its HTTP
+    ## response, a Promptflow slot) when the response body is closed
+    g.setdefault("stream_closers", []).append(close)
+
+
+class _ClosingBody:
+    ## Response body iterator that runs the registered closers once it is
+    ## closed. Closing an async generator that was never started does not
+    ## close the streams it would have read, e.g. when the client goes away
+    ## before the body is sent.
+    def __init__(self, body, closers):
+        self._body = body
+        self._closers = closers
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._body.__anext__()
+
+    async def aclose(self):
+        try:
+            await self._body.aclose()
+        finally:
+            for close in self._closers:
+                try:
+                    await close()
+                except Exception:
+                    logging.exception("Exception while closing the response stream")
+
+
+def get_request_user():
+    ## The signed-in user of the current request, resolved once and kept on g
+    if "authenticated_user" not in g:
+        g.authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    return g.authenticated_user
+
+
+def admission_controlled(route):
+    ## Admit the request through the worker's AdmissionController, or answer
+    ## 429 with Retry-After right away. The slot is held until the response,
+    ## streamed or not, has been sent.
+    @functools.wraps(route)
+    async def wrapper(*args, **kwargs):
+        admission = getattr(current_app, "admission", None)
+        if admission is None:
+            return await route(*args, **kwargs)
+
+        authenticated_user = get_request_user()
+        estimated_tokens = (
+            estimate_tokens(await request.get_data(as_text=True))
+            + app_settings.azure_openai.max_tokens
+        )
+        try:
+            release_slot = admission.admit(authenticated_user["user_principal_id"], estimated_tokens)
+        except AdmissionRejectedError as e:
+            logging.debug("Request rejected by admission control: %s", e.reason)
+            metrics.ADMISSION_REJECTED.inc(reason=e.reason)
+            response = jsonify({"error": str(e)})
+            response.status_code = e.status_code
+            response.headers["Retry-After"] = e.retry_after_header
+            return response
+
+        metrics.ADMISSION_IN_FLIGHT.inc()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                release_slot()
+                metrics.ADMISSION_IN_FLIGHT.dec()
+
+        try:
+            response = await make_response(await route(*args, **kwargs))
+        except BaseException:
+            release()
+            raise
+
+        if isinstance(response.response, IterableBody):
+            response.response.iter = _ReleasingBody(response.response.iter, release)
+        else:
+            release()
+        return response
+
+    return wrapper
+
+
+def is_debug_trace_request(request_headers) -> bool:
+    ## Operators get the full phase trace of a request by sending
+    ## DEBUG_TRACE_TOKEN in the X-Debug-Trace header
+    token = app_settings.base_settings.debug_trace_token
+    supplied = request_headers.get("X-Debug-Trace")
+    if not token or not supplied:
+        return False
+    return hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8"))
+
+
+def request_timed(route):
+    ## Time the phases of the request and report them in a Server-Timing
+    ## header. Phases of a streamed answer that end after the headers are
+    ## sent (time to first token, stream duration) are reported on the last
+    ## event of the stream instead.
+    @functools.wraps(route)
+    async def wrapper(*args, **kwargs):
+        debug = is_debug_trace_request(request.headers)
+        if not app_settings.base_settings.server_timing_enabled and not debug:
+            return await route(*args, **kwargs)
+
+        timer = timing.start(debug=debug)
+        # Resolved here so that every request reports it; the routes and
+        # admission control read it back with get_request_user
+        with timer.phase("auth"):
+            get_request_user()
+        response = await make_response(await route(*args, **kwargs))
+        response.headers["Server-Timing"] = timer.header()
+        return response
+
+    return wrapper
+
+
+@bp.route("/admission/metrics", methods=["GET"])
+async def admission_metrics():
+    ## Per-worker snapshot: requests in flight (the queue depth, since requests
+    ## over the limits are rejected rather than queued) and rejection counts
+    admission = getattr(current_app, "admission", None)
+    if admission is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **admission.stats()}), 200
+
+
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    ## Prometheus scrape endpoint, in the OpenMetrics format (with
+    ## apim-request-id exemplars when not in multiprocess mode) when the
+    ## scraper asks for it
+    if not app_settings.metrics.enabled:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+
+    openmetrics = "application/openmetrics-text" in request.headers.get("Accept", "")
+    body, content_type = metrics.render(openmetrics=openmetrics)
+    return body, 200, {"Content-Type": content_type}
+
+
 @bp.route("/conversation", methods=["POST"])
+@request_timed
+@admission_controlled
 async def conversation():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
-    request_json = await request.get_json()
+    try:
+        with timing.phase("parse"):
+            chat_request = ChatRequest.model_validate_json(await request.get_data())
+    except ValidationError as e:
+        return jsonify({"error": str(e)}), 400
 
-    return await conversation_internal(request_json, request.headers)
+    return await conversation_internal(chat_request, request.headers)
 
 
 @bp.route("/frontend_settings", methods=["GET"])
@@ -424,14 +1034,20 @@ def get_frontend_settings():
 
 ## Conversation History API ##
 @bp.route("/history/generate", methods=["POST"])
+@request_timed
+@admission_controlled
 async def add_conversation():
     await cosmos_db_ready.wait()
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
-    ## check request for conversation_id
-    request_json = await request.get_json()
-    conversation_id = request_json.get("conversation_id", None)
+    ## parse and validate the body once; the same object is used for history and for the completion
+    try:
+        with timing.phase("parse"):
+            chat_request = ChatRequest.model_validate_json(await request.get_data())
+    except ValidationError as e:
+        return jsonify({"error": str(e)}), 400
+    conversation_id = chat_request.conversation_id
 
     try:
         # make sure cosmos is configured
@@ -439,40 +1055,47 @@ async def add_conversation():
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
+        # with a placeholder title; the real title is generated alongside the answer
         history_metadata = {}
+        title_task = None
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            title = placeholder_title(chat_request.messages)
             conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
             conversation_id = conversation_dict["id"]
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
+            if app_settings.chat_history.title_strategy != "heuristic":
+                title_task = asyncio.ensure_future(
+                    generate_and_save_title(user_id, conversation_id, chat_request.messages)
+                )
+                title_tasks.add(title_task)
+                title_task.add_done_callback(title_task_done)
 
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
+        messages = chat_request.messages
+        if len(messages) > 0 and messages[-1].role == "user":
             createdMessageValue = await current_app.cosmos_conversation_client.create_message(
                 uuid=str(uuid.uuid4()),
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_message=messages[-1].to_history_message(),
             )
             if createdMessageValue == "Conversation not found":
-                raise Exception(
-                    "Conversation not found for the given conversation ID: "
-                    + conversation_id
-                    + "."
-                )
+                return jsonify({
+                    "error": f"Conversation not found for the given conversation ID: {conversation_id}."
+                }), 404
         else:
             raise Exception("No user message found")
 
         # Submit request to Chat Completions for response
-        request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
-        request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        chat_request.history_metadata = history_metadata
+        return await conversation_internal(
+            chat_request, request.headers, late_history_metadata=title_task
+        )
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
@@ -482,7 +1105,7 @@ async def add_conversation():
 @bp.route("/history/update", methods=["POST"])
 async def update_conversation():
     await cosmos_db_ready.wait()
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
@@ -504,19 +1127,27 @@ async def update_conversation():
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await current_app.cosmos_conversation_client.create_message(
+                createdMessageValue = await current_app.cosmos_conversation_client.create_message(
                     uuid=str(uuid.uuid4()),
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2],
                 )
+                if createdMessageValue == "Conversation not found":
+                    return jsonify({
+                        "error": f"Conversation not found for the given conversation ID: {conversation_id}."
+                    }), 404
             # write the assistant message
-            await current_app.cosmos_conversation_client.create_message(
+            createdMessageValue = await current_app.cosmos_conversation_client.create_message(
                 uuid=messages[-1]["id"],
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1],
             )
+            if createdMessageValue == "Conversation not found":
+                return jsonify({
+                    "error": f"Conversation not found for the given conversation ID: {conversation_id}."
+                }), 404
         else:
             raise Exception("No bot messages found")
 
@@ -532,7 +1163,7 @@ async def update_conversation():
 @bp.route("/history/message_feedback", methods=["POST"])
 async def update_message():
     await cosmos_db_ready.wait()
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for message_id
@@ -579,7 +1210,7 @@ async def update_message():
 async def delete_conversation():
     await cosmos_db_ready.wait()
     ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
@@ -594,13 +1225,16 @@ async def delete_conversation():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        ## delete the conversation messages from cosmos first
-        deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-            conversation_id, user_id
-        )
+        if run_in_background():
+            return await start_delete_job(
+                user_id,
+                lambda job: current_app.cosmos_conversation_client.delete_conversation_and_messages(
+                    user_id, conversation_id, job
+                ),
+            )
 
-        ## Now delete the conversation
-        deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
+        ## delete the conversation messages from cosmos first, then the conversation
+        deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation_and_messages(
             user_id, conversation_id
         )
 
@@ -621,46 +1255,105 @@ async def delete_conversation():
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
     await cosmos_db_ready.wait()
-    offset = request.args.get("offset", 0)
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    offset = request.args.get("offset", 0, type=int)
+    cursor = request.args.get("cursor", None)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## make sure cosmos is configured
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    ## a cursor from the previous response resumes the query; offset is kept for existing clients
+    continuation_token = None
+    if cursor:
+        try:
+            continuation_token = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
     ## get the conversations from cosmos
-    conversations = await current_app.cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
+    try:
+        conversations, next_token = await current_app.cosmos_conversation_client.get_conversations_page(
+            user_id, limit=25, continuation_token=continuation_token, offset=offset
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
     ## return the conversation ids
 
-    return jsonify(conversations), 200
+    response = jsonify(conversations)
+    if next_token:
+        response.headers["X-Next-Cursor"] = encode_cursor(next_token)
+
+    ## let the browser revalidate with If-None-Match and skip the body when nothing changed
+    etag = hashlib.sha256(await response.get_data() + (next_token or "").encode("utf-8")).hexdigest()
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    if request.if_none_match.contains(etag):
+        response.set_data(b"")
+        response.status_code = 304
+        return response
+    return response, 200
 
 
 @bp.route("/history/read", methods=["POST"])
 async def get_conversation():
     await cosmos_db_ready.wait()
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
     request_json = await request.get_json()
     conversation_id = request_json.get("conversation_id", None)
+    ## optional incremental fetch: only messages newer than since / after_message_id,
+    ## and/or only the newest `limit` messages older than the `before` cursor
+    since = request_json.get("since", None)
+    after_message_id = request_json.get("after_message_id", None)
+    before = request_json.get("before", None)
+    limit = request_json.get("limit", None)
 
     if not conversation_id:
         return jsonify({"error": "conversation_id is required"}), 400
 
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+
+    if since is not None:
+        try:
+            if not isinstance(since, str):
+                raise TypeError()
+            datetime.fromisoformat(since)
+        except (TypeError, ValueError):
+            return jsonify({"error": "since must be an ISO 8601 timestamp"}), 400
+
+    if after_message_id is not None and not isinstance(after_message_id, str):
+        return jsonify({"error": "after_message_id must be a string"}), 400
+
+    if before:
+        try:
+            before = decode_cursor(before)
+            datetime.fromisoformat(before)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
     ## make sure cosmos is configured
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversation object and the related messages from cosmos
-    conversation = await current_app.cosmos_conversation_client.get_conversation(
-        user_id, conversation_id
+    ## get the conversation object and the related messages from cosmos; both are keyed by id so run them together
+    conversation, (conversation_messages, older_cursor) = await asyncio.gather(
+        current_app.cosmos_conversation_client.get_conversation(user_id, conversation_id),
+        current_app.cosmos_conversation_client.get_messages_page(
+            user_id,
+            conversation_id,
+            since=since,
+            after_message_id=after_message_id,
+            before=before,
+            limit=limit,
+        ),
     )
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
@@ -673,10 +1366,8 @@ async def get_conversation():
             404,
         )
 
-    # get the messages for the conversation from cosmos
-    conversation_messages = await current_app.cosmos_conversation_client.get_messages(
-        user_id, conversation_id
-    )
+    if conversation_messages is None:
+        return jsonify({"error": f"Message {after_message_id} was not found in conversation {conversation_id}"}), 404
 
     ## format the messages in the bot frontend format
     messages = [
@@ -690,13 +1381,16 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    response = {"conversation_id": conversation_id, "messages": messages}
+    if older_cursor:
+        response["older_cursor"] = encode_cursor(older_cursor)
+    return jsonify(response), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
 async def rename_conversation():
     await cosmos_db_ready.wait()
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
@@ -740,7 +1434,7 @@ async def rename_conversation():
 async def delete_all_conversations():
     await cosmos_db_ready.wait()
     ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     # get conversations for user
@@ -749,23 +1443,20 @@ async def delete_all_conversations():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await current_app.cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
+        if run_in_background():
+            return await start_delete_job(
+                user_id,
+                lambda job: current_app.cosmos_conversation_client.delete_all_conversations(
+                    user_id, job
+                ),
+            )
+
+        deleted_conversations = await current_app.cosmos_conversation_client.delete_all_conversations(
+            user_id
         )
-        if not conversations:
+        if not deleted_conversations:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
-            )
-
-            ## Now delete the conversation
-            deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
         return (
             jsonify(
                 {
@@ -784,7 +1475,7 @@ async def delete_all_conversations():
 async def clear_messages():
     await cosmos_db_ready.wait()
     ## get the user id from the request headers
-    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    authenticated_user = get_request_user()
     user_id = authenticated_user["user_principal_id"]
 
     ## check request for conversation_id
@@ -799,6 +1490,14 @@ async def clear_messages():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        if run_in_background():
+            return await start_delete_job(
+                user_id,
+                lambda job: current_app.cosmos_conversation_client.delete_messages(
+                    conversation_id, user_id, job
+                ),
+            )
+
         ## delete the conversation messages from cosmos
         deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
             conversation_id, user_id
@@ -818,6 +1517,39 @@ async def clear_messages():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/history/delete_status/<job_id>", methods=["GET"])
+async def get_delete_status(job_id):
+    await cosmos_db_ready.wait()
+    authenticated_user = get_request_user()
+    user_id = authenticated_user["user_principal_id"]
+
+    try:
+        ## make sure cosmos is configured
+        if not current_app.cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        job = await current_app.cosmos_conversation_client.get_delete_job(user_id, job_id)
+        if not job:
+            return jsonify({"error": f"Delete job {job_id} was not found"}), 404
+
+        return jsonify(job), 200
+    except Exception as e:
+        logging.exception("Exception in /history/delete_status")
+        return jsonify({"error": str(e)}), 500
+
+
+def run_in_background():
+    return request.args.get("background", "false").lower() == "true"
+
+
+async def start_delete_job(user_id, delete):
+    job = await current_app.cosmos_conversation_client.start_delete_job(user_id, delete)
+    status_url = f"/history/delete_status/{job['id']}"
+    response = jsonify({"job_id": job["id"], "status": job["status"], "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
     await cosmos_db_ready.wait()
@@ -831,7 +1563,15 @@ async def ensure_cosmos():
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        return jsonify({"message": "CosmosDB is configured and working"}), 200
+        return (
+            jsonify(
+                {
+                    "message": "CosmosDB is configured and working",
+                    "indexing": current_app.cosmos_conversation_client.indexing_report,
+                }
+            ),
+            200,
+        )
     except Exception as e:
         logging.exception("Exception in /history/ensure")
         cosmos_exception = str(e)
@@ -859,27 +1599,82 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+def placeholder_title(conversation_messages) -> str:
+    ## local keyword title, final for the heuristic strategy and shown until the model's title arrives otherwise
+    return heuristic_title(
+        first_user_message(conversation_messages), app_settings.chat_history.title_max_words
+    )
+
+
+def first_user_message(conversation_messages) -> str:
+    for msg in conversation_messages:
+        if msg.role == "user" and isinstance(msg.content, str):
+            return msg.content
+    return ""
+
+
+def title_task_done(task):
+    title_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Exception while generating title", exc_info=task.exception())
+
+
+async def generate_and_save_title(user_id, conversation_id, conversation_messages) -> dict:
+    title = await generate_title(conversation_messages)
+    try:
+        await current_app.cosmos_conversation_client.update_conversation_title(
+            user_id, conversation_id, title
+        )
+    except Exception:
+        logging.exception("Exception while saving conversation title")
+    return {"title": title}
+
+
+@metrics.timed(
+    metrics.TITLE_GENERATION_SECONDS,
+    strategy=app_settings.chat_history.title_strategy if app_settings.chat_history else "llm"
+)
+@timing.timed_phase("title")
 async def generate_title(conversation_messages) -> str:
+    title_settings = app_settings.chat_history
+    if title_settings and title_settings.title_strategy == "heuristic":
+        return placeholder_title(conversation_messages)
+
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
-    messages = [
-        {"role": msg["role"], "content": msg["content"]}
-        for msg in conversation_messages
-    ]
+    model = app_settings.azure_openai.model
+    max_tokens = 64
+    if title_settings and title_settings.title_strategy == "truncated_llm":
+        ## only the start of the conversation, which is what the title is about anyway
+        model = title_settings.title_deployment or model
+        max_tokens = 16
+        messages = []
+        budget = title_settings.title_context_tokens
+        for msg in conversation_messages:
+            if budget <= 0:
+                break
+            content = truncate_to_tokens(msg.content, budget)
+            budget -= estimate_tokens(content)
+            messages.append({"role": msg.role, "content": content})
+    else:
+        messages = [msg.to_history_message() for msg in conversation_messages]
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = await init_openai_client()
-        response = await azure_openai_client.chat.completions.create(
-            model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
+        azure_openai_pool = await get_openai_pool()
+        if not azure_openai_pool:
+            raise Exception("Azure OpenAI client is not configured or not working")
+        raw_response = await azure_openai_pool.create(
+            {"model": model, "messages": messages, "temperature": 1, "max_tokens": max_tokens}
         )
+        response = raw_response.parse()
 
         title = response.choices[0].message.content
         return title
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        return placeholder_title(conversation_messages)
 
 
 app = create_app()
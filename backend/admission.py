@@ -0,0 +1,142 @@
+import math
+import time
+from typing import Callable, Optional
+
+from backend.cache import TTLCache
+
+
+class AdmissionRejectedError(Exception):
+    status_code = 429
+
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    '''
+    Allows bursts of up to capacity and refills at rate per second.
+    '''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, amount: float = 1) -> float:
+        '''
+        Take amount tokens and return 0, or return the seconds until they
+        will be available without taking anything. Amounts over the capacity
+        are capped to it, so they wait for a full bucket instead of forever.
+        '''
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def give_back(self, amount: float = 1) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionController:
+    '''
+    Decides per worker whether a chat request is started now or rejected
+    right away: a cap on requests in flight, a token bucket of requests per
+    user, and a bucket of estimated model tokens per minute. A limit of 0
+    disables that check.
+    '''
+
+    def __init__(
+        self,
+        max_in_flight: int = 0,
+        user_requests_per_minute: float = 0,
+        user_burst: int = 0,
+        tokens_per_minute: int = 0,
+        max_users: int = 10000,
+    ):
+        self.max_in_flight = max_in_flight
+        self.user_requests_per_minute = user_requests_per_minute
+        self.user_burst = user_burst or max(1, math.ceil(user_requests_per_minute / 6))
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = {"in_flight": 0, "user_rate": 0, "token_budget": 0}
+        # Idle buckets expire once they would have refilled anyway
+        self._user_buckets = TTLCache(
+            maxsize=max_users,
+            ttl=60 * self.user_burst / user_requests_per_minute if user_requests_per_minute else 0
+        )
+        self._token_bucket = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        )
+
+    def _reject(self, message: str, reason: str, retry_after: float):
+        self.rejected[reason] += 1
+        raise AdmissionRejectedError(message, reason, retry_after)
+
+    def admit(self, user_id: str, estimated_tokens: int = 0) -> Callable[[], None]:
+        '''
+        Admit a request, or raise AdmissionRejectedError. Returns the
+        function that frees its slot, which may safely be called more than
+        once.
+        '''
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self._reject("The server is busy, please try again later.", "in_flight", 1)
+
+        user_bucket: Optional[TokenBucket] = None
+        if self.user_requests_per_minute:
+            user_bucket = self._user_buckets.get(user_id)
+            if user_bucket is None:
+                user_bucket = TokenBucket(self.user_requests_per_minute / 60, self.user_burst)
+            self._user_buckets.set(user_id, user_bucket)
+            wait = user_bucket.take()
+            if wait:
+                self._reject("Too many requests, please slow down.", "user_rate", wait)
+
+        if self._token_bucket and estimated_tokens:
+            wait = self._token_bucket.take(estimated_tokens)
+            if wait:
+                if user_bucket:
+                    user_bucket.give_back()
+                self._reject("The server is busy, please try again later.", "token_budget", wait)
+
+        self.in_flight += 1
+        self.admitted += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+
+        return release
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "tracked_users": len(self._user_buckets),
+            "available_tokens": (
+                int(self._token_bucket.available()) if self._token_bucket else None
+            ),
+        }
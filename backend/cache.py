@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class TTLCache:
+    '''
+    In-process LRU cache whose entries expire after a fixed time to live.
+    A ttl of 0 or less disables caching.
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._pending: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def get_or_set(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        '''
+        Return the cached value for key, or await factory() to produce it.
+        Concurrent callers for the same key share a single factory call.
+        None results are returned but not cached.
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        task: Optional[asyncio.Future] = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._pending[key] = task
+
+            def _store(done: asyncio.Future):
+                self._pending.pop(key, None)
+                if not done.cancelled() and done.exception() is None:
+                    if done.result() is not None:
+                        self.set(key, done.result())
+
+            task.add_done_callback(_store)
+
+        return await asyncio.shield(task)
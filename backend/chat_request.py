@@ -0,0 +1,128 @@
+import json
+from typing import Any, Callable, List, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+from backend.utils import estimate_tokens
+
+# Tokens the chat format adds around every message, on top of its content
+TOKENS_PER_MESSAGE = 4
+
+
+class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    role: str
+    content: Any = None
+    id: Optional[str] = None
+    # Citations of an earlier assistant answer, as the JSON string the frontend sends back
+    context: Optional[Any] = None
+
+    def to_history_message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def count_tokens(self, count_tokens: Callable[[str], int], with_context: bool = True) -> int:
+        tokens = TOKENS_PER_MESSAGE + count_tokens(_as_text(self.content))
+        if with_context and self.context is not None:
+            tokens += count_tokens(_as_text(self.context))
+        return tokens
+
+
+def _as_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _kept_contexts(messages: List[ChatMessage], contexts_to_keep: Optional[int]) -> set:
+    # Indexes of the assistant messages whose citations are still sent: the
+    # most recent contexts_to_keep of them, or all when it is not set
+    with_context = [
+        index for index, message in enumerate(messages)
+        if message.role == "assistant" and message.context is not None
+    ]
+    if contexts_to_keep is None:
+        return set(with_context)
+    return set(with_context[len(with_context) - contexts_to_keep:]) if contexts_to_keep > 0 else set()
+
+
+class ChatRequest(BaseModel):
+    '''
+    The body of /conversation and /history/generate, parsed and validated
+    once and passed through the whole request pipeline.
+    '''
+    model_config = ConfigDict(extra="allow")
+
+    messages: List[ChatMessage] = []
+    conversation_id: Optional[str] = None
+    history_metadata: dict = Field(default_factory=dict)
+
+    @field_validator("messages", mode="before")
+    @classmethod
+    def drop_empty_messages(cls, messages):
+        if isinstance(messages, list):
+            return [message for message in messages if message]
+        return messages
+
+    def trim_history(
+        self,
+        token_budget: int,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+        reserved_tokens: int = 0,
+        contexts_to_keep: Optional[int] = None,
+    ) -> Tuple[List[ChatMessage], int, int]:
+        '''
+        Keep the most recent whole turns (a user message and the answers
+        that follow it) that fit in token_budget minus reserved_tokens. The
+        latest turn is always kept, even when it alone is over the budget.
+        Returns the kept messages and the token counts before and after.
+        '''
+        messages = [message for message in self.messages if message.role != "tool"]
+        kept_contexts = _kept_contexts(messages, contexts_to_keep)
+
+        turns = []
+        turn_tokens = 0
+        for index in range(len(messages) - 1, -1, -1):
+            turn_tokens += messages[index].count_tokens(count_tokens, index in kept_contexts)
+            if messages[index].role == "user" or index == 0:
+                turns.append((index, turn_tokens))
+                turn_tokens = 0
+
+        tokens_before = sum(tokens for _, tokens in turns)
+        available = token_budget - reserved_tokens
+        first = len(messages)
+        tokens_after = 0
+        for start, tokens in turns:
+            if first < len(messages) and tokens_after + tokens > available:
+                break
+            first = start
+            tokens_after += tokens
+
+        return messages[first:], tokens_before, tokens_after
+
+    def to_openai_messages(
+        self,
+        messages: Optional[List[ChatMessage]] = None,
+        contexts_to_keep: Optional[int] = None,
+    ) -> List[dict]:
+        # One pass: tool messages are only shown in the UI, and assistant
+        # citation contexts are decoded back into objects
+        if messages is None:
+            messages = self.messages
+        messages = [message for message in messages if message.role != "tool"]
+        kept_contexts = _kept_contexts(messages, contexts_to_keep)
+
+        openai_messages = []
+        for index, message in enumerate(messages):
+            if index in kept_contexts:
+                context = message.context
+                if isinstance(context, str):
+                    context = json.loads(context)
+                openai_messages.append(
+                    {"role": message.role, "content": message.content, "context": context}
+                )
+            else:
+                openai_messages.append({"role": message.role, "content": message.content})
+        return openai_messages
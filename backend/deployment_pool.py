@@ -0,0 +1,188 @@
+import time
+import random
+import logging
+from typing import List, Optional
+
+from backend import metrics, timing
+from backend.retry import CircuitBreaker, RetryPolicy, get_retry_after, is_retryable
+
+# Rate limit headers older than this describe an earlier quota window
+QUOTA_WINDOW_SECONDS = 60.0
+
+
+class Deployment:
+    '''
+    One Azure OpenAI deployment of the pool, with its client, its circuit
+    breaker, the requests in flight to it and its last reported quota.
+    '''
+
+    def __init__(self, client, model: str, weight: float = 1.0, name: Optional[str] = None, breaker=None):
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.name = name or model
+        self.breaker = breaker or CircuitBreaker()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.remaining_tokens: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.quota_updated_at = 0.0
+
+    def update_quota(self, headers) -> None:
+        if not headers:
+            return
+        try:
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if remaining_tokens is not None:
+                self.remaining_tokens = int(remaining_tokens)
+            if remaining_requests is not None:
+                self.remaining_requests = int(remaining_requests)
+            if remaining_tokens is not None or remaining_requests is not None:
+                self.quota_updated_at = time.monotonic()
+        except ValueError:
+            pass
+
+    def is_low_on_quota(self, tokens_needed: int) -> bool:
+        if time.monotonic() - self.quota_updated_at > QUOTA_WINDOW_SECONDS:
+            return False
+        return (
+            (self.remaining_tokens is not None and self.remaining_tokens < tokens_needed)
+            or self.remaining_requests == 0
+        )
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "state": self.breaker.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "remaining_tokens": self.remaining_tokens,
+            "remaining_requests": self.remaining_requests,
+        }
+
+
+class DeploymentPool:
+    '''
+    Spreads chat completions over several Azure OpenAI deployments. Each
+    call goes to the less busy, relative to its weight, of two deployments
+    drawn by weight, avoiding deployments whose circuit is open or whose
+    reported quota cannot fit the request. A throttled or failing call fails
+    over to the other deployments right away; once all of them have failed,
+    the retry policy backs off before the next round.
+
+    Requests for default_model are sent to each deployment's own model
+    deployment name; other model names are sent unchanged.
+    '''
+
+    def __init__(self, deployments: List[Deployment], retry_policy: RetryPolicy, default_model: str):
+        if not deployments:
+            raise ValueError("At least one Azure OpenAI deployment is required")
+        self.deployments = deployments
+        self.retry_policy = retry_policy
+        self.default_model = default_model
+
+    def blocked_for(self) -> float:
+        # The pool is only blocked while every deployment is
+        return min(deployment.breaker.blocked_for() for deployment in self.deployments)
+
+    def record_success(self) -> None:
+        pass
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        # Failures are recorded on the deployment that failed
+        pass
+
+    def select(self, exclude=(), tokens_needed: int = 0) -> Optional[Deployment]:
+        candidates = [
+            deployment for deployment in self.deployments
+            if deployment not in exclude and deployment.breaker.blocked_for() == 0
+        ]
+        if not candidates:
+            return None
+        if len(candidates) > 2:
+            first = random.choices(candidates, weights=[d.weight for d in candidates])[0]
+            rest = [d for d in candidates if d is not first]
+            second = random.choices(rest, weights=[d.weight for d in rest])[0]
+            candidates = [first, second]
+        return min(
+            candidates,
+            key=lambda d: (d.is_low_on_quota(tokens_needed), d.outstanding / d.weight, random.random())
+        )
+
+    def _update_quota(self, deployment: Deployment, headers) -> None:
+        deployment.update_quota(headers)
+        if deployment.remaining_tokens is not None:
+            metrics.DEPLOYMENT_REMAINING_TOKENS.set(deployment.remaining_tokens, deployment=deployment.name)
+
+    async def _send(self, deployment: Deployment, model_args: dict, timeout: float):
+        if model_args.get("model") == self.default_model:
+            model_args = {**model_args, "model": deployment.model}
+
+        deployment.outstanding += 1
+        deployment.requests += 1
+        metrics.DEPLOYMENT_OUTSTANDING.inc(deployment=deployment.name)
+        try:
+            with timing.phase("upstream_attempt", detail=deployment.name):
+                raw_response = await deployment.client.chat.completions.with_raw_response.create(
+                    **model_args, timeout=timeout
+                )
+        except Exception as e:
+            response = getattr(e, "response", None)
+            self._update_quota(deployment, getattr(response, "headers", None))
+            if is_retryable(e):
+                deployment.failures += 1
+                deployment.breaker.record_failure(get_retry_after(getattr(response, "headers", None)))
+                metrics.DEPLOYMENT_CIRCUIT_OPEN_UNTIL.set(
+                    time.time() + deployment.breaker.blocked_for(), deployment=deployment.name
+                )
+            raise
+        finally:
+            deployment.outstanding -= 1
+            metrics.DEPLOYMENT_OUTSTANDING.dec(deployment=deployment.name)
+
+        self._update_quota(deployment, raw_response.headers)
+        deployment.breaker.record_success()
+        return raw_response
+
+    async def create(self, model_args: dict, started_at: Optional[float] = None):
+        '''
+        Send a chat completion request to the pool and return the raw
+        response, whose headers are read before it is parsed.
+        '''
+        tokens_needed = model_args.get("max_tokens") or 0
+
+        async def attempt(timeout):
+            tried = []
+            last_error = None
+            while True:
+                deployment = self.select(exclude=tried, tokens_needed=tokens_needed)
+                if deployment is None:
+                    if last_error is not None:
+                        raise last_error
+                    # Every circuit is open: use the one that reopens first
+                    deployment = min(self.deployments, key=lambda d: d.breaker.blocked_for())
+                try:
+                    return await self._send(deployment, model_args, timeout)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    last_error = e
+                    tried.append(deployment)
+                    if len(tried) < len(self.deployments):
+                        logging.warning(
+                            "Azure OpenAI deployment %s failed (%s), failing over",
+                            deployment.name, getattr(e, "status_code", type(e).__name__)
+                        )
+
+        return await self.retry_policy.call(attempt, breaker=self, started_at=started_at)
+
+    async def close(self) -> None:
+        for deployment in self.deployments:
+            await deployment.client.close()
+
+    def stats(self) -> List[dict]:
+        return [deployment.stats() for deployment in self.deployments]
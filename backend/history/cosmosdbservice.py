@@ -1,16 +1,105 @@
 import uuid
+import base64
+import asyncio
+import logging
 from datetime import datetime
+from azure.core.async_paging import AsyncItemPaged
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from backend import metrics, timing
+from backend.cache import TTLCache
+
+## how often a background delete job writes its progress back to its status document
+DELETE_JOB_PROGRESS_INTERVAL = 2.0
+## finished delete job documents expire after a day when the container has TTL enabled
+DELETE_JOB_TTL = 86400
+## fields the history sidebar needs from each conversation
+CONVERSATION_LIST_FIELDS = "c.id, c.title, c.createdAt, c.updatedAt"
+## fields /history/read returns for each message
+MESSAGE_FIELDS = "c.id, c.role, c.content, c.createdAt, c.feedback"
+## composite indexes matching the history queries: conversations by user sorted on updatedAt,
+## messages by conversation sorted on createdAt
+RECOMMENDED_COMPOSITE_INDEXES = [
+    [
+        {'path': '/userId', 'order': 'ascending'},
+        {'path': '/type', 'order': 'ascending'},
+        {'path': '/updatedAt', 'order': 'descending'}
+    ],
+    [
+        {'path': '/conversationId', 'order': 'ascending'},
+        {'path': '/type', 'order': 'ascending'},
+        {'path': '/createdAt', 'order': 'ascending'}
+    ]
+]
+## message content is large and never filtered or sorted on, so indexing it only adds write RUs
+## /content/? covers string content, /content/* the arrays and objects of multimodal messages
+RECOMMENDED_EXCLUDED_PATHS = ['/content/?', '/content/*']
+## sort direction of the last path in each recommended composite index
+RECOMMENDED_SORT_ORDERS = {'updatedAt': 'DESC', 'createdAt': 'ASC'}
+## how long a conversation seen by this worker is trusted to exist when appending messages in write-behind mode
+KNOWN_CONVERSATION_TTL = 60
+
+
+def _composite_index_key(composite_index):
+    return tuple((path['path'], path.get('order', 'ascending')) for path in composite_index)
+
+
+def _has_composite_index(composite_indexes, recommended):
+    ## an index also serves queries sorting every path in the opposite direction
+    wanted = _composite_index_key(recommended)
+    inverted = tuple((path, 'descending' if order == 'ascending' else 'ascending') for path, order in wanted)
+    existing = {_composite_index_key(index) for index in composite_indexes}
+    return wanted in existing or inverted in existing
+
+
+def _timed(operation):
+    timed = metrics.timed(
+        metrics.COSMOS_OPERATION_SECONDS, span_name=f"cosmos.{operation}", operation=operation
+    )
+    phase = timing.timed_phase(f"cosmos.{operation}")
+    return lambda func: phase(timed(func))
+
+
+def encode_cursor(continuation_token):
+    ## Cosmos continuation tokens are JSON; clients get them as an opaque, URL safe string
+    return base64.urlsafe_b64encode(continuation_token.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        continuation_token = base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (AttributeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not continuation_token:
+        raise ValueError("Invalid cursor")
+    return continuation_token
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, conversation_write_behind_seconds: float = 0, delete_concurrency: int = 16, list_cache_ttl: float = 0, list_cache_size: int = 1024):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        ## when greater than 0, conversation updatedAt bumps are debounced and written in the background
+        self.conversation_write_behind_seconds = conversation_write_behind_seconds
+        self._pending_conversation_updates = {}
+        self._write_behind_task = None
+        ## conversations recently read or created here, so write-behind appends can skip the existence check
+        self._known_conversations = TTLCache(maxsize=4096, ttl=KNOWN_CONVERSATION_TTL)
+        ## cumulative request units consumed per operation, read from the x-ms-request-charge response header
+        self.request_charges = {}
+        ## number of delete requests a bulk delete keeps in flight at once
+        self.delete_concurrency = max(1, delete_concurrency)
+        self._delete_tasks = set()
+        ## per user, continuation tokens for the page that starts at a given offset, so offset paging can resume instead of skipping
+        self._conversation_list_cursors = TTLCache(maxsize=4096, ttl=600)
+        ## first page of each user's conversation list, dropped whenever one of their conversations changes
+        self._conversation_list_cache = TTLCache(maxsize=list_cache_size, ttl=list_cache_ttl)
+        ## set by check_indexing_policy; ORDER BY clauses only name the filter paths once the composite indexes exist
+        self.use_composite_indexes = False
+        self.indexing_report = None
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -30,6 +119,25 @@ class CosmosConversationClient():
             raise ValueError("Invalid CosmosDB container name") 
         
 
+    def invalidate_conversation_list(self, user_id):
+        ## saved cursors point into the old list order, so they go too
+        self._conversation_list_cache.delete(user_id)
+        self._conversation_list_cursors.delete(user_id)
+
+    def _track_charge(self, operation):
+        def response_hook(headers, result):
+            ## query_items calls the hook once before any page is fetched; each page then reports its own charge
+            if isinstance(result, AsyncItemPaged):
+                return
+            charge = float(headers.get('x-ms-request-charge', 0) or 0)
+            stats = self.request_charges.setdefault(operation, {'count': 0, 'request_charge': 0.0})
+            stats['count'] += 1
+            stats['request_charge'] += charge
+            metrics.COSMOS_REQUEST_CHARGE.inc(charge, operation=operation)
+            logging.debug(f"CosmosDB {operation} request charge: {charge} RU")
+        return response_hook
+
+    @_timed("ensure")
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
             return False, "CosmosDB client not initialized correctly"
@@ -42,9 +150,73 @@ class CosmosConversationClient():
             container_info = await self.container_client.read()
         except:
             return False, f"CosmosDB container {self.container_name} not found"
-            
+
+        self.check_indexing_policy(container_info)
         return True, "CosmosDB client initialized successfully"
 
+    def check_indexing_policy(self, container_info):
+        ## report the recommended composite indexes and excluded paths the container does not have
+        indexing_policy = container_info.get('indexingPolicy', {})
+        composite_indexes = indexing_policy.get('compositeIndexes', [])
+        excluded_paths = {path['path'] for path in indexing_policy.get('excludedPaths', [])}
+
+        missing_composite_indexes = [
+            index for index in RECOMMENDED_COMPOSITE_INDEXES
+            if not _has_composite_index(composite_indexes, index)
+        ]
+        missing_excluded_paths = [
+            path for path in RECOMMENDED_EXCLUDED_PATHS
+            if path not in excluded_paths and path.replace('/?', '/*') not in excluded_paths
+        ]
+
+        use_composite_indexes = not missing_composite_indexes
+        if use_composite_indexes != self.use_composite_indexes:
+            ## continuation tokens belong to the query text they came from
+            self._conversation_list_cursors.clear()
+            self._conversation_list_cache.clear()
+        self.use_composite_indexes = use_composite_indexes
+        self.indexing_report = {
+            'missing_composite_indexes': missing_composite_indexes,
+            'missing_excluded_paths': missing_excluded_paths
+        }
+        if missing_composite_indexes or missing_excluded_paths:
+            logging.warning(f"CosmosDB container {self.container_name} indexing policy is missing recommended entries: {self.indexing_report}")
+        return self.indexing_report
+
+    @_timed("apply_recommended_indexing_policy")
+    async def apply_recommended_indexing_policy(self):
+        ## add the missing recommended entries to the existing policy; everything else on the container is kept
+        container_info = await self.container_client.read()
+        report = self.check_indexing_policy(container_info)
+        if not report['missing_composite_indexes'] and not report['missing_excluded_paths']:
+            return False
+
+        indexing_policy = dict(container_info.get('indexingPolicy', {}))
+        indexing_policy['compositeIndexes'] = indexing_policy.get('compositeIndexes', []) + report['missing_composite_indexes']
+        indexing_policy['excludedPaths'] = indexing_policy.get('excludedPaths', []) + [
+            {'path': path} for path in report['missing_excluded_paths']
+        ]
+        await self.database_client.replace_container(
+            self.container_client,
+            partition_key=container_info['partitionKey'],
+            indexing_policy=indexing_policy,
+            default_ttl=container_info.get('defaultTtl'),
+            conflict_resolution_policy=container_info.get('conflictResolutionPolicy'),
+            analytical_storage_ttl=container_info.get('analyticalStorageTtl')
+        )
+        logging.info(f"Applied recommended indexing policy to CosmosDB container {self.container_name}")
+        ## queries keep the single path ORDER BY until the next check, so they do not depend on an index still being built
+        self.indexing_report = {'missing_composite_indexes': [], 'missing_excluded_paths': []}
+        return True
+
+    def _order_by(self, filter_paths, sort_path, sort_order):
+        ## with the composite index in place, repeat the equality filters in ORDER BY so Cosmos can serve the sort from it
+        if not self.use_composite_indexes:
+            return f"c.{sort_path} {sort_order}"
+        filter_order = 'ASC' if sort_order == RECOMMENDED_SORT_ORDERS[sort_path] else 'DESC'
+        return ", ".join([f"c.{path} {filter_order}" for path in filter_paths] + [f"c.{sort_path} {sort_order}"])
+
+    @_timed("create_conversation")
     async def create_conversation(self, user_id, title = ''):
         conversation = {
             'id': str(uuid.uuid4()),  
@@ -55,78 +227,266 @@ class CosmosConversationClient():
             'title': title
         }
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        resp = await self.container_client.upsert_item(conversation, response_hook=self._track_charge('create_conversation'))  
+        self.invalidate_conversation_list(user_id)
         if resp:
+            self._known_conversations.set((user_id, conversation['id']), True)
             return resp
         else:
             return False
     
+    @_timed("upsert_conversation")
     async def upsert_conversation(self, conversation):
-        resp = await self.container_client.upsert_item(conversation)
+        resp = await self.container_client.upsert_item(conversation, response_hook=self._track_charge('upsert_conversation'))
+        self.invalidate_conversation_list(conversation['userId'])
         if resp:
             return resp
         else:
             return False
 
+    @_timed("delete_conversation")
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        self.invalidate_conversation_list(user_id)
+        self._known_conversations.delete((user_id, conversation_id))
+        try:
+            resp = await self.container_client.delete_item(
+                item=conversation_id,
+                partition_key=user_id,
+                response_hook=self._track_charge('delete_conversation')
+            )
             return resp
-        else:
+        except exceptions.CosmosResourceNotFoundError:
             return True
 
-        
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    async def _get_item_ids(self, query, parameters, operation):
+        ## projection query, only the ids are read back
+        item_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters, response_hook=self._track_charge(operation)):
+            item_ids.append(item['id'])
+        return item_ids
 
+    async def _delete_items(self, user_id, item_ids, operation, job=None):
+        ## a fixed pool of workers drains the shared iterator, so at most delete_concurrency deletes are in flight
+        remaining = iter(item_ids)
+        if job is not None:
+            job['total'] += len(item_ids)
 
-    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        async def worker():
+            for item_id in remaining:
+                try:
+                    await self.container_client.delete_item(
+                        item=item_id,
+                        partition_key=user_id,
+                        response_hook=self._track_charge(operation)
+                    )
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+                if job is not None:
+                    job['deleted'] += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(self.delete_concurrency, len(item_ids)))))
+
+    @_timed("delete_messages")
+    async def delete_messages(self, conversation_id, user_id, job=None):
         parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-        
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+        query = f"SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        message_ids = await self._get_item_ids(query, parameters, 'get_message_ids')
+        if message_ids:
+            await self._delete_items(user_id, message_ids, 'delete_message', job)
+            return message_ids
 
-    async def get_conversation(self, user_id, conversation_id):
+    @_timed("delete_conversation_and_messages")
+    async def delete_conversation_and_messages(self, user_id, conversation_id, job=None):
+        ## messages go first so a failure part way through never leaves messages without their conversation
+        await self.delete_messages(conversation_id, user_id, job)
+        if job is not None:
+            job['total'] += 1
+        resp = await self.delete_conversation(user_id, conversation_id)
+        if job is not None:
+            job['deleted'] += 1
+        return resp
+
+    @_timed("delete_all_conversations")
+    async def delete_all_conversations(self, user_id, job=None):
         parameters = [
             {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        conversation_ids = await self._get_item_ids(
+            "SELECT c.id FROM c WHERE c.userId = @userId AND c.type='conversation'", parameters, 'get_conversation_ids'
+        )
+        if not conversation_ids:
+            return 0
+
+        message_ids = await self._get_item_ids(
+            "SELECT c.id FROM c WHERE c.userId = @userId AND c.type='message'", parameters, 'get_message_ids'
+        )
+        await self._delete_items(user_id, message_ids, 'delete_message', job)
+        for conversation_id in conversation_ids:
+            self._known_conversations.delete((user_id, conversation_id))
+        await self._delete_items(user_id, conversation_ids, 'delete_conversation', job)
+        self.invalidate_conversation_list(user_id)
+        return len(conversation_ids)
+
+    async def start_delete_job(self, user_id, delete):
+        ## runs delete(job) in the background; progress is kept in a status document so any worker can report it
+        job = {
+            'id': str(uuid.uuid4()),
+            'type': 'deleteJob',
+            'userId': user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'status': 'running',
+            'total': 0,
+            'deleted': 0,
+            'error': None,
+            'ttl': DELETE_JOB_TTL
+        }
+        await self._save_delete_job(job)
+        task = asyncio.ensure_future(self._run_delete_job(job, delete))
+        self._delete_tasks.add(task)
+        task.add_done_callback(self._delete_tasks.discard)
+        return job
+
+    async def _save_delete_job(self, job):
+        job['updatedAt'] = datetime.utcnow().isoformat()
+        await self.container_client.upsert_item(dict(job), response_hook=self._track_charge('save_delete_job'))
+
+    async def _run_delete_job(self, job, delete):
+        async def report_progress():
+            while True:
+                await asyncio.sleep(DELETE_JOB_PROGRESS_INTERVAL)
+                try:
+                    await self._save_delete_job(job)
+                except Exception:
+                    logging.exception(f"Failed to save progress of delete job {job['id']}")
+
+        reporter = asyncio.ensure_future(report_progress())
+        try:
+            await delete(job)
+            job['status'] = 'succeeded'
+        except asyncio.CancelledError:
+            job['status'] = 'cancelled'
+        except Exception as e:
+            logging.exception(f"Delete job {job['id']} failed")
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            reporter.cancel()
+            await self._save_delete_job(job)
+
+    @_timed("get_delete_job")
+    async def get_delete_job(self, user_id, job_id):
+        try:
+            job = await self.container_client.read_item(
+                item=job_id,
+                partition_key=user_id,
+                response_hook=self._track_charge('get_delete_job')
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+        if job.get('type') != 'deleteJob':
+            return None
+        return {key: job.get(key) for key in ('id', 'status', 'total', 'deleted', 'error', 'createdAt', 'updatedAt')}
+
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        conversations, _ = await self.get_conversations_page(user_id, limit, sort_order, offset=offset)
+        return conversations
+
+    @_timed("get_conversations_page")
+    async def get_conversations_page(self, user_id, limit, sort_order = 'DESC', continuation_token = None, offset = 0):
+        ## returns (conversations, next continuation token); the token is None on the last page
+        parameters = [
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+        query = f"SELECT {CONVERSATION_LIST_FIELDS} FROM c where c.userId = @userId and c.type='conversation' order by {self._order_by(['userId', 'type'], 'updatedAt', sort_order)}"
+        offset = int(offset or 0)
+
+        if limit is None:
+            conversations = []
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=self._track_charge('get_conversations')):
+                conversations.append(item)
+            return conversations, None
+
+        first_page = continuation_token is None and not offset
+        if first_page:
+            cached = self._conversation_list_cache.get(user_id)
+            if cached and cached[0] == (sort_order, limit):
+                return cached[1], cached[2]
+
+        if continuation_token is None and offset:
+            continuation_token = self._conversation_list_cursors.get(user_id, {}).get((sort_order, limit, offset))
+            if continuation_token is None:
+                ## no saved position for this offset, fall back to OFFSET/LIMIT
+                query += f" offset {offset} limit {limit}"
+                conversations = []
+                async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=self._track_charge('get_conversations')):
+                    conversations.append(item)
+                return conversations, None
+
+        pages = self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=user_id,
+            max_item_count=limit,
+            response_hook=self._track_charge('get_conversations')
+        ).by_page(continuation_token)
+
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        try:
+            async for page in pages:
+                async for item in page:
+                    conversations.append(item)
+                break
+        except exceptions.CosmosHttpResponseError as e:
+            ## Cosmos rejects a continuation token that was altered or belongs to another query
+            if e.status_code == 400 and continuation_token:
+                raise ValueError("Invalid cursor") from e
+            raise
+
+        next_token = pages.continuation_token
+        if next_token:
+            cursors = self._conversation_list_cursors.get(user_id, {})
+            cursors[(sort_order, limit, offset + len(conversations))] = next_token
+            self._conversation_list_cursors.set(user_id, cursors)
+        if first_page:
+            self._conversation_list_cache.set(user_id, ((sort_order, limit), conversations, next_token))
+        return conversations, next_token
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    @_timed("get_conversation")
+    async def get_conversation(self, user_id, conversation_id):
+        ## point read on id and partition key; a missing item or a non-conversation document means not found
+        try:
+            conversation = await self.container_client.read_item(
+                item=conversation_id,
+                partition_key=user_id,
+                response_hook=self._track_charge('get_conversation')
+            )
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversations[0]
+
+        if conversation.get('type') != 'conversation':
+            return None
+        self._known_conversations.set((user_id, conversation_id), True)
+        return conversation
  
+    @_timed("create_message")
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
         message = {
             'id': uuid,
@@ -141,29 +501,111 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
+
+        ## the deferred timestamp update cannot report a missing conversation, so check it up front with a point read,
+        ## unless this worker has created or read the conversation within the last KNOWN_CONVERSATION_TTL seconds
+        if self.conversation_write_behind_seconds > 0 and not self._known_conversations.get((user_id, conversation_id)):
+            if not await self.get_conversation(user_id, conversation_id):
+                return "Conversation not found"
         
-        resp = await self.container_client.upsert_item(message)  
+        resp = await self.container_client.upsert_item(message, response_hook=self._track_charge('create_message'))  
         if resp:
             ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+            if self.conversation_write_behind_seconds > 0:
+                self._schedule_conversation_update(user_id, conversation_id, message['createdAt'])
+                return resp
+
+            if not await self.update_conversation_timestamp(user_id, conversation_id, message['createdAt']):
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
+
+    @_timed("update_conversation_timestamp")
+    async def update_conversation_timestamp(self, user_id, conversation_id, updated_at):
+        ## partial document update, so the conversation does not have to be read and rewritten
+        self.invalidate_conversation_list(user_id)
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': updated_at}],
+                response_hook=self._track_charge('update_conversation_timestamp')
+            )
+            return True
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+
+    @_timed("update_conversation_title")
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        self.invalidate_conversation_list(user_id)
+        try:
+            return await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/title', 'value': title}],
+                response_hook=self._track_charge('update_conversation_title')
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+
+    def _schedule_conversation_update(self, user_id, conversation_id, updated_at):
+        ## keep only the latest timestamp per conversation until the next flush
+        self.invalidate_conversation_list(user_id)
+        self._pending_conversation_updates[(user_id, conversation_id)] = updated_at
+        if self._write_behind_task is None or self._write_behind_task.done():
+            self._write_behind_task = asyncio.ensure_future(self._flush_conversation_updates_later())
+
+    async def _flush_conversation_updates_later(self):
+        await asyncio.sleep(self.conversation_write_behind_seconds)
+        await self.flush_conversation_updates()
+
+    @_timed("flush_conversation_updates")
+    async def flush_conversation_updates(self):
+        pending, self._pending_conversation_updates = self._pending_conversation_updates, {}
+        results = await asyncio.gather(
+            *(
+                self.update_conversation_timestamp(user_id, conversation_id, updated_at)
+                for (user_id, conversation_id), updated_at in pending.items()
+            ),
+            return_exceptions=True
+        )
+        for (user_id, conversation_id), result in zip(pending, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to update conversation {conversation_id}: {result}")
+            elif not result:
+                logging.warning(f"Conversation {conversation_id} not found while updating its timestamp")
+
+    async def close(self):
+        if self._write_behind_task and not self._write_behind_task.done():
+            self._write_behind_task.cancel()
+        for task in list(self._delete_tasks):
+            task.cancel()
+        await asyncio.gather(*self._delete_tasks, return_exceptions=True)
+        await self.flush_conversation_updates()
+        await self.cosmosdb_client.close()
     
+    @_timed("update_message_feedback")
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
+        try:
+            resp = await self.container_client.patch_item(
+                item=message_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback}],
+                response_hook=self._track_charge('update_message_feedback')
+            )
             return resp
-        else:
+        except exceptions.CosmosResourceNotFoundError:
             return False
 
     async def get_messages(self, user_id, conversation_id):
+        messages, _ = await self.get_messages_page(user_id, conversation_id)
+        return messages
+
+    @_timed("get_messages_page")
+    async def get_messages_page(self, user_id, conversation_id, since = None, after_message_id = None, before = None, limit = None):
+        ## returns (messages in ascending order, createdAt of the oldest message when older ones remain)
+        ## or (None, None) when after_message_id does not exist in the conversation
         parameters = [
             {
                 'name': '@conversationId',
@@ -174,10 +616,42 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        filters = ""
+
+        if after_message_id:
+            try:
+                anchor = await self.container_client.read_item(
+                    item=after_message_id,
+                    partition_key=user_id,
+                    response_hook=self._track_charge('get_message')
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                return None, None
+            if anchor.get('type') != 'message' or anchor.get('conversationId') != conversation_id:
+                return None, None
+            since = max(since or '', anchor['createdAt'])
+
+        if since:
+            filters += " AND c.createdAt > @since"
+            parameters.append({'name': '@since', 'value': since})
+        if before:
+            filters += " AND c.createdAt < @before"
+            parameters.append({'name': '@before', 'value': before})
+
+        if limit is None:
+            query = f"SELECT {MESSAGE_FIELDS} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId{filters} ORDER BY {self._order_by(['conversationId', 'type'], 'createdAt', 'ASC')}"
+        else:
+            ## newest window first, one extra row tells whether older messages remain
+            query = f"SELECT TOP {int(limit) + 1} {MESSAGE_FIELDS} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId{filters} ORDER BY {self._order_by(['conversationId', 'type'], 'createdAt', 'DESC')}"
+
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, response_hook=self._track_charge('get_messages')):
             messages.append(item)
 
-        return messages
+        if limit is None:
+            return messages, None
 
+        has_older = len(messages) > limit
+        messages = messages[:limit]
+        messages.reverse()
+        return messages, messages[0]['createdAt'] if has_older and messages else None
@@ -0,0 +1,240 @@
+import os
+import time
+import functools
+from contextlib import nullcontext
+from typing import Optional, Sequence, Tuple
+
+import prometheus_client
+from prometheus_client import multiprocess
+from prometheus_client.openmetrics import exposition as openmetrics_exposition
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+_enabled = False
+_tracer = None
+
+
+def configure(enabled: bool, otel_enabled: bool = False) -> None:
+    '''
+    Turn recording on or off for this worker; while off, every metric and
+    span is a no-op. Spans are only created with otel_enabled and the
+    opentelemetry package installed, and are exported by whatever
+    OpenTelemetry SDK the process is configured with.
+    '''
+    global _enabled, _tracer
+    _enabled = enabled
+    _tracer = trace.get_tracer("sample-app-aoai-chatgpt") if otel_enabled and trace else None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _Metric:
+    def __init__(self, metric):
+        self._metric = metric
+
+    def _child(self, labels: dict):
+        return self._metric.labels(**labels) if labels else self._metric
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(prometheus_client.Counter(name, documentation, labelnames))
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if _enabled:
+            self._child(labels).inc(amount)
+
+
+class Gauge(_Metric):
+    '''
+    Gauge set by each worker; multiprocess_mode says how the values of the
+    live workers are combined (livesum, livemax, livemin or liveall).
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        multiprocess_mode: str = "livesum",
+    ):
+        super().__init__(prometheus_client.Gauge(
+            name, documentation, labelnames, multiprocess_mode=multiprocess_mode
+        ))
+
+    def set(self, value: float, **labels) -> None:
+        if _enabled:
+            self._child(labels).set(value)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if _enabled:
+            self._child(labels).inc(amount)
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        if _enabled:
+            self._child(labels).dec(amount)
+
+
+class Histogram(_Metric):
+    '''
+    An observation can carry an exemplar, e.g. the apim-request-id of the
+    call it measured, rendered in the OpenMetrics format. prometheus_client
+    does not keep exemplars in multiprocess mode.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def observe(self, value: float, exemplar: Optional[dict] = None, **labels) -> None:
+        if _enabled:
+            self._child(labels).observe(value, exemplar)
+
+
+def render(openmetrics: bool = False) -> Tuple[bytes, str]:
+    '''
+    Metrics in the Prometheus text or OpenMetrics format, with their content
+    type. With PROMETHEUS_MULTIPROC_DIR set, as gunicorn.conf.py does, these
+    are the metrics of every worker rather than only the one serving the
+    scrape.
+    '''
+    registry = prometheus_client.REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    if openmetrics:
+        return openmetrics_exposition.generate_latest(registry), openmetrics_exposition.CONTENT_TYPE_LATEST
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def span(name: str, **attributes):
+    '''
+    OpenTelemetry span around a block, or a no-op when spans are off.
+    '''
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(
+        name, attributes={k: v for k, v in attributes.items() if v is not None}
+    )
+
+
+def timed(histogram: Histogram, span_name: Optional[str] = None, **labels):
+    '''
+    Decorator recording the duration of an async function in histogram, with
+    an outcome label of ok or error, and wrapping it in a span.
+    '''
+    def decorator(func):
+        name = span_name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not _enabled:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with span(name):
+                    result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - start, outcome=outcome, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+CHAT_REQUEST_SECONDS = Histogram(
+    "aoai_chat_request_seconds",
+    "Time until Azure OpenAI answered a chat completion, or sent the response headers of a stream, retries included.",
+    ["outcome"],
+)
+CHAT_TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "aoai_chat_time_to_first_token_seconds",
+    "Time from sending a streamed chat completion to its first answer token.",
+)
+CHAT_STREAM_SECONDS = Histogram(
+    "aoai_chat_stream_seconds",
+    "Time from sending a streamed chat completion to its last chunk.",
+)
+CHAT_TOKENS_PER_SECOND = Histogram(
+    "aoai_chat_completion_tokens_per_second",
+    "Answer tokens generated per second after the first token of a streamed chat completion.",
+    buckets=RATE_BUCKETS,
+)
+CHAT_COMPLETION_TOKENS = Counter(
+    "aoai_chat_completion_tokens",
+    "Answer tokens generated by chat completions, counted as streamed chunks for streams.",
+    ["stream"],
+)
+NDJSON_ENCODE_SECONDS = Histogram(
+    "ndjson_encode_seconds",
+    "Time spent encoding the NDJSON lines of one streamed response.",
+    buckets=FAST_BUCKETS,
+)
+COSMOS_OPERATION_SECONDS = Histogram(
+    "cosmos_operation_seconds",
+    "Duration of chat history operations on CosmosDB.",
+    ["operation", "outcome"],
+)
+COSMOS_REQUEST_CHARGE = Counter(
+    "cosmos_request_charge",
+    "Request units charged by CosmosDB for chat history operations.",
+    ["operation"],
+)
+GRAPH_FILTER_SECONDS = Histogram(
+    "graph_filter_seconds",
+    "Time to build the document-level access filter of a user, Microsoft Graph group lookup included.",
+    ["outcome"],
+)
+TITLE_GENERATION_SECONDS = Histogram(
+    "title_generation_seconds",
+    "Time to generate the title of a new conversation.",
+    ["strategy", "outcome"],
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight",
+    "Chat requests being served, summed over the live workers.",
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected",
+    "Chat requests rejected by admission control.",
+    ["reason"],
+)
+PROMPT_CACHE_LOOKUPS = Counter(
+    "prompt_cache_lookups",
+    "Prompt cache lookups.",
+    ["result"],
+)
+DEPLOYMENT_OUTSTANDING = Gauge(
+    "aoai_deployment_outstanding_requests",
+    "Requests in flight to each Azure OpenAI deployment, summed over the live workers.",
+    ["deployment"],
+)
+DEPLOYMENT_REMAINING_TOKENS = Gauge(
+    "aoai_deployment_remaining_tokens",
+    "Remaining tokens of each Azure OpenAI deployment's quota, as last reported in x-ratelimit-remaining-tokens; the lowest value seen by a live worker.",
+    ["deployment"],
+    multiprocess_mode="livemin",
+)
+DEPLOYMENT_CIRCUIT_OPEN_UNTIL = Gauge(
+    "aoai_deployment_circuit_open_until_seconds",
+    "Unix time until which calls to an Azure OpenAI deployment are blocked by its circuit breaker, in any live worker; the circuit is open while this is greater than time().",
+    ["deployment"],
+    multiprocess_mode="livemax",
+)
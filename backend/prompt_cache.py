@@ -0,0 +1,166 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from backend.cache import TTLCache
+from backend.utils import redact_secrets
+
+# Arguments that do not change the answer and are left out of the cache key
+UNKEYED_MODEL_ARGS = ("stream", "user")
+
+
+def prompt_cache_key(model_args: dict) -> Optional[str]:
+    '''
+    Stable hash of a fully prepared request, or None when the request is not
+    deterministic enough to be answered from the cache: that takes a
+    temperature of 0 and a fixed seed.
+    '''
+    if model_args.get("temperature") != 0 or model_args.get("seed") is None:
+        return None
+
+    keyed = redact_secrets({k: v for k, v in model_args.items() if k not in UNKEYED_MODEL_ARGS})
+    return hashlib.sha256(
+        json.dumps(keyed, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class PromptCacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: dict) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryPromptCacheBackend(PromptCacheBackend):
+    '''
+    LRU cache in the memory of one worker process.
+    '''
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[dict]:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: dict) -> None:
+        self._entries.set(key, value)
+
+
+class SqlitePromptCacheBackend(PromptCacheBackend):
+    '''
+    LRU cache in a SQLite file, shared by every worker process on the host.
+    Queries run in a thread so they do not block the event loop.
+    '''
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._connection = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._lock = asyncio.Lock()
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS prompt_cache_used_at ON prompt_cache (used_at)"
+            )
+
+    def _get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM prompt_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE prompt_cache SET used_at = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def _set(self, key: str, value: dict) -> None:
+        now = time.time()
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO prompt_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now)
+            )
+            self._connection.execute("DELETE FROM prompt_cache WHERE expires_at <= ?", (now,))
+            self._connection.execute(
+                "DELETE FROM prompt_cache WHERE key IN ("
+                "SELECT key FROM prompt_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    async def get(self, key: str) -> Optional[dict]:
+        async with self._lock:
+            return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: dict) -> None:
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, value)
+
+    async def close(self) -> None:
+        async with self._lock:
+            self._connection.close()
+
+
+class PromptCache:
+    '''
+    Exact-match cache of answers to deterministic requests, in front of the
+    Azure OpenAI call. Counts hits and misses; cache errors are logged and
+    treated as misses so they never fail a request.
+    '''
+
+    def __init__(self, backend: PromptCacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model_args: dict) -> Optional[str]:
+        return prompt_cache_key(model_args)
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            value = await self.backend.get(key)
+        except Exception:
+            logging.exception("Failed to read from the prompt cache")
+            value = None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, response: dict) -> None:
+        entry = {k: v for k, v in response.items() if k != "history_metadata"}
+        if not entry.get("choices") or not entry["choices"][0]["messages"]:
+            return
+        try:
+            await self.backend.set(key, entry)
+        except Exception:
+            logging.exception("Failed to write to the prompt cache")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    async def close(self) -> None:
+        await self.backend.close()
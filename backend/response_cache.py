@@ -0,0 +1,149 @@
+import re
+import json
+import time
+import hashlib
+import unicodedata
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+from backend.cache import TTLCache
+
+# Arguments that do not change the answer and are left out of the cache key
+UNKEYED_MODEL_ARGS = ("messages", "stream", "user", "extra_body")
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    '''
+    Fold the case, punctuation and spacing differences between otherwise
+    identical questions, e.g. "What is the PTO policy?" and "what is the
+    pto policy".
+    '''
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class ResponseCache:
+    '''
+    LRU cache of answers to standalone questions. Entries are keyed on the
+    normalized question, a hash of the model and data source configuration
+    and a hash of the caller's document-level security filter, so an answer
+    is only replayed to callers whose filter is identical.
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, model_args: dict) -> Optional[tuple]:
+        '''
+        Cache key for a request, or None when the request is not cacheable:
+        only the first question of a conversation is, since the answer to a
+        follow-up depends on the turns before it.
+        '''
+        messages = model_args["messages"]
+        question = messages[-1] if messages else None
+        if (
+            not question
+            or question["role"] != "user"
+            or not isinstance(question["content"], str)
+            or any(message["role"] == "assistant" for message in messages)
+        ):
+            return None
+
+        data_sources = []
+        security_filters = []
+        for data_source in (model_args.get("extra_body") or {}).get("data_sources", []):
+            parameters = dict(data_source["parameters"])
+            security_filters.append(parameters.pop("filter", None))
+            data_sources.append({"type": data_source["type"], "parameters": parameters})
+
+        config = {k: v for k, v in model_args.items() if k not in UNKEYED_MODEL_ARGS}
+        config["messages"] = messages[:-1]
+        config["data_sources"] = data_sources
+
+        return (
+            normalize_question(question["content"]),
+            _hash(config),
+            _hash(security_filters),
+        )
+
+    def get(self, key: tuple) -> Optional[dict]:
+        return self._entries.get(key)
+
+    def set(self, key: tuple, response: dict) -> None:
+        '''
+        Store a formatted non-streaming response, without its history
+        metadata, which belongs to the conversation it was produced for.
+        '''
+        entry = {k: v for k, v in response.items() if k != "history_metadata"}
+        if entry.get("choices") and entry["choices"][0]["messages"]:
+            self._entries.set(key, entry)
+
+
+async def record_stream(
+    events: AsyncGenerator,
+    on_complete: Callable[[dict], Awaitable[None]]
+) -> AsyncGenerator:
+    '''
+    Pass formatted stream events through and, once the stream completes,
+    hand the answer they add up to, as a non-streaming response, to
+    on_complete.
+    '''
+    first = None
+    tool_content = None
+    content = []
+    async for event in events:
+        if event and first is None:
+            first = event
+        for message in event.get("choices", [{}])[0].get("messages", []) if event else []:
+            if message.get("role") == "tool":
+                tool_content = message["content"]
+            elif message.get("content"):
+                content.append(message["content"])
+        yield event
+
+    if first is not None and content:
+        messages = [{"role": "assistant", "content": "".join(content)}]
+        if tool_content is not None:
+            messages.insert(0, {"role": "tool", "content": tool_content})
+        await on_complete({
+            "id": first["id"],
+            "model": first["model"],
+            "created": first["created"],
+            "object": "chat.completion",
+            "choices": [{"messages": messages}],
+            "apim-request-id": first.get("apim-request-id"),
+        })
+
+
+def cached_response(entry: dict, history_metadata: dict) -> dict:
+    return {**entry, "created": int(time.time()), "history_metadata": history_metadata}
+
+
+async def replay_cached_response(entry: dict, history_metadata: dict) -> AsyncGenerator:
+    '''
+    Replay a cached answer as the events of a streamed response: the
+    citations first, then the answer, as the frontend expects them.
+    '''
+    created = int(time.time())
+    for message in entry["choices"][0]["messages"]:
+        yield {
+            "id": entry["id"],
+            "model": entry["model"],
+            "created": created,
+            "object": "chat.completion.chunk",
+            "choices": [{"messages": [message]}],
+            "history_metadata": history_metadata,
+            "apim-request-id": entry.get("apim-request-id"),
+        }
@@ -0,0 +1,179 @@
+import math
+import time
+import random
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+import openai
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def get_retry_after(headers) -> Optional[float]:
+    '''
+    Seconds to wait before retrying, from the retry-after-ms or retry-after
+    header of a throttled or unavailable response, if either is present.
+    '''
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    '''
+    Throttling and failure state of one Azure OpenAI deployment, shared by
+    every request in the worker. A 429 with a retry-after blocks all callers
+    until it has passed, and failure_threshold failures in a row block them
+    for reset_timeout. Once the block ends, the next call is a probe: one
+    more failure blocks again, a success closes the circuit.
+    '''
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.blocked_until = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.blocked_for() > 0:
+            return "open"
+        if self.failure_threshold and self.failures >= self.failure_threshold:
+            return "half_open"
+        return "closed"
+
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        self.failures += 1
+        now = time.monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        if self.failure_threshold and self.failures >= self.failure_threshold:
+            self.blocked_until = max(self.blocked_until, now + self.reset_timeout)
+
+
+class RetryPolicy:
+    '''
+    Retries transient failures with decorrelated jitter backoff, waiting at
+    least as long as the deployment asks to, and never past the deadline of
+    the request.
+    '''
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        deadline: float = 200.0,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def next_delay(self, previous_delay: float) -> float:
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
+
+    async def call(
+        self,
+        attempt: Callable[[float], Awaitable[T]],
+        breaker: Optional[CircuitBreaker] = None,
+        started_at: Optional[float] = None,
+    ) -> T:
+        '''
+        Await attempt(timeout) until it succeeds, with timeout the seconds
+        left before the deadline counted from started_at. For a streamed
+        completion the attempt returns once the response headers are in, so
+        retries only ever happen before the first streamed byte.
+        '''
+        deadline_at = (started_at or time.monotonic()) + self.deadline
+        delay = self.base_delay
+        retries = 0
+        while True:
+            if breaker:
+                blocked_for = breaker.blocked_for()
+                if blocked_for > 0:
+                    # Wait out short blocks, fail fast on long ones
+                    if blocked_for > self.max_delay or time.monotonic() + blocked_for >= deadline_at:
+                        raise CircuitOpenError(
+                            "Azure OpenAI is throttling or unavailable, please try again later.",
+                            blocked_for
+                        )
+                    await asyncio.sleep(blocked_for + random.uniform(0, self.base_delay))
+
+            remaining = deadline_at - time.monotonic()
+            try:
+                result = await attempt(remaining)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+
+                retry_after = get_retry_after(getattr(getattr(e, "response", None), "headers", None))
+                if breaker:
+                    breaker.record_failure(retry_after)
+
+                if retry_after is not None:
+                    # Spread the retries of every request throttled at once
+                    wait = retry_after + random.uniform(0, self.base_delay)
+                else:
+                    delay = self.next_delay(delay)
+                    wait = delay
+                if retries >= self.max_retries or time.monotonic() + wait >= deadline_at:
+                    raise
+                retries += 1
+                logging.warning(
+                    "Azure OpenAI request failed (%s), retry %d of %d in %.1fs",
+                    getattr(e, "status_code", type(e).__name__), retries, self.max_retries, wait
+                )
+                await asyncio.sleep(wait)
+                continue
+
+            if breaker:
+                breaker.record_success()
+            return result
@@ -1,7 +1,9 @@
 import os
 import json
 import logging
+import tempfile
 from abc import ABC, abstractmethod
+from functools import cached_property
 from pydantic import (
     BaseModel,
     confloat,
@@ -19,6 +21,7 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
+from backend.cache import TTLCache
 from backend.utils import parse_multi_columns, generateFilterString
 
 DOTENV_PATH = os.environ.get(
@@ -64,6 +67,19 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    conversation_write_behind_seconds: float = 0
+    delete_concurrency: int = 16
+    list_cache_ttl: float = 0
+    list_cache_size: int = 1024
+    apply_indexing_policy: bool = False
+    title_timeout: float = 10.0
+    # llm: the whole conversation is summarized by the chat deployment
+    # truncated_llm: only the first title_context_tokens tokens are sent, to title_deployment if set
+    # heuristic: keyword phrases from the first user message, no model call
+    title_strategy: Literal["llm", "truncated_llm", "heuristic"] = "llm"
+    title_max_words: int = 4
+    title_context_tokens: int = 256
+    title_deployment: Optional[str] = None
 
 
 class _PromptflowSettings(BaseSettings):
@@ -80,6 +96,69 @@ class _PromptflowSettings(BaseSettings):
     request_field_name: str = "query"
     response_field_name: str = "reply"
     citations_field_name: str = "documents"
+    stream: bool = False
+    http2: bool = True
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    max_concurrent_requests: int = 16
+    queue_timeout: float = 10.0
+
+
+class _ResponseCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="RESPONSE_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    ttl: float = 3600.0
+    max_entries: int = 1024
+
+
+class _PromptCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="PROMPT_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    backend: Literal["none", "memory", "sqlite"] = "none"
+    path: str = os.path.join(tempfile.gettempdir(), "prompt_cache.sqlite3")
+    ttl: float = 86400.0
+    max_entries: int = 10000
+
+
+class _AdmissionSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="ADMISSION_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    max_in_flight: int = 0
+    user_requests_per_minute: float = 0
+    user_burst: int = 0
+    tokens_per_minute: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_in_flight or self.user_requests_per_minute or self.tokens_per_minute)
+
+
+class _MetricsSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="METRICS_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    otel_enabled: bool = False
 
 
 class _AzureOpenAIFunction(BaseModel):
@@ -93,6 +172,24 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
+class _AzureOpenAIDeployment(BaseModel):
+    endpoint: Optional[str] = None
+    resource: Optional[str] = None
+    key: Optional[str] = None
+    model: Optional[str] = None
+    weight: float = Field(default=1.0, gt=0)
+
+    @model_validator(mode="after")
+    def check_endpoint(self) -> Self:
+        if not self.endpoint and not self.resource:
+            raise ValueError("Each of AZURE_OPENAI_DEPLOYMENTS needs an endpoint or a resource")
+        return self
+
+    @property
+    def base_url(self) -> str:
+        return self.endpoint or f"https://{self.resource}.openai.azure.com/"
+
+
 class _AzureOpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
@@ -123,6 +220,19 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_endpoint: Optional[str] = None
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    max_retries: int = 3
+    retry_base_delay: float = 0.5
+    retry_max_delay: float = 8.0
+    request_deadline: float = 200.0
+    circuit_failure_threshold: int = 5
+    circuit_reset_timeout: float = 30.0
+    deployments: Optional[List[_AzureOpenAIDeployment]] = None
+    history_token_budget: Optional[int] = None
+    history_contexts_to_keep: Optional[int] = None
+    tokenizer_model: Optional[str] = None
     
     @field_validator('tools', mode='before')
     @classmethod
@@ -161,14 +271,32 @@ class _AzureOpenAISettings(BaseSettings):
     @model_validator(mode="after")
     def ensure_endpoint(self) -> Self:
         if self.endpoint:
-            return Self
+            return self
         
         elif self.resource:
             self.endpoint = f"https://{self.resource}.openai.azure.com"
-            return Self
+            return self
+
+        elif self.deployments:
+            # Every request goes to AZURE_OPENAI_DEPLOYMENTS
+            return self
         
-        raise ValidationError("AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required")
+        raise ValueError("AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_RESOURCE or AZURE_OPENAI_DEPLOYMENTS is required")
         
+    def get_deployments(self) -> List[_AzureOpenAIDeployment]:
+        # AZURE_OPENAI_DEPLOYMENTS, or the single deployment of AZURE_OPENAI_ENDPOINT
+        if self.deployments:
+            return self.deployments
+        return [
+            _AzureOpenAIDeployment.model_construct(
+                endpoint=self.endpoint,
+                resource=self.resource,
+                key=self.key,
+                model=self.model,
+                weight=1.0
+            )
+        ]
+
     def extract_embedding_dependency(self) -> Optional[dict]:
         if self.embedding_name:
             return {
@@ -230,12 +358,29 @@ class DatasourcePayloadConstructor(BaseModel, ABC):
         self._settings = settings
     
     @abstractmethod
-    def construct_payload_configuration(
+    def construct_payload_template(self) -> dict:
+        '''
+        Build the parts of the data source payload that do not depend on the
+        request. Called once; the result is reused for every request.
+        '''
+        pass
+
+    @cached_property
+    def payload_template(self) -> dict:
+        return self.construct_payload_template()
+
+    async def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        pass
+        # The template is shared across requests and must not be modified;
+        # per-request fields are set on a shallow copy of its parameters.
+        template = self.payload_template
+        return {
+            "type": template["type"],
+            "parameters": dict(template["parameters"])
+        }
 
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -270,6 +415,9 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         'vectorSemanticHybrid'
     ] = "simple"
     permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_cache_ttl: float = Field(default=300.0, exclude=True)
+    permitted_groups_cache_size: int = Field(default=1024, exclude=True)
+    _user_groups_cache: TTLCache = PrivateAttr()
     
     # Constructed fields
     endpoint: Optional[str] = None
@@ -314,8 +462,17 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     @model_validator(mode="after")
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
+        return self
 
-    def _set_filter_string(self, request: Request) -> str:
+    @model_validator(mode="after")
+    def set_user_groups_cache(self) -> Self:
+        self._user_groups_cache = TTLCache(
+            maxsize=self.permitted_groups_cache_size,
+            ttl=self.permitted_groups_cache_ttl
+        )
+        return self
+
+    async def _set_filter_string(self, request: Request) -> str:
         if self.permitted_groups_column:
             user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
@@ -324,21 +481,19 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            # Group membership is cached per signed-in user, so Microsoft Graph
+            # is called at most once per user per AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL
+            filter_string = await generateFilterString(
+                user_token,
+                userGroupsCache=self._user_groups_cache,
+                principalId=request.headers.get("X-Ms-Client-Principal-Id")
+            )
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
         return None
             
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -349,6 +504,20 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
             "parameters": parameters
         }
 
+    async def construct_payload_configuration(
+        self,
+        *args,
+        **kwargs
+    ):
+        request = kwargs.pop('request', None)
+        payload = await super().construct_payload_configuration(*args, **kwargs)
+        if request and self.permitted_groups_column:
+            filter_string = await self._set_filter_string(request)
+            if filter_string:
+                payload["parameters"]["filter"] = filter_string
+        
+        return payload
+
 
 class _AzureCosmosDbMongoVcoreSettings(
     BaseSettings,
@@ -407,11 +576,7 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -477,11 +642,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             {"type": "model_id", "model_id": self.embedding_model_id} if self.embedding_model_id else \
             self._settings.azure_openai.extract_embedding_dependency() 
@@ -549,11 +710,7 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -607,11 +764,7 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -654,11 +807,7 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
             }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         #parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -728,11 +877,7 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def construct_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
             
@@ -756,6 +901,10 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    stream_coalesce_window_ms: int = 0
+    stream_coalesce_max_bytes: int = 0
+    server_timing_enabled: bool = False
+    debug_trace_token: Optional[str] = None
 
 
 class _AppSettings(BaseModel):
@@ -763,6 +912,10 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    response_cache: _ResponseCacheSettings = _ResponseCacheSettings()
+    prompt_cache: _PromptCacheSettings = _PromptCacheSettings()
+    admission: _AdmissionSettings = _AdmissionSettings()
+    metrics: _MetricsSettings = _MetricsSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
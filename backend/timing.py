@@ -0,0 +1,129 @@
+import time
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, List, Optional
+
+_current_timer: ContextVar[Optional["RequestTimer"]] = ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    '''
+    Phases of one request, in the order they started, with their durations.
+    Phases with the same name (e.g. several CosmosDB writes) add up in the
+    Server-Timing header and stay separate in the debug trace.
+    '''
+
+    def __init__(self, debug: bool = False):
+        self.started_at = time.monotonic()
+        self.debug = debug
+        self.phases: List[dict] = []
+
+    def add(self, name: str, start: float, duration: float, detail: Optional[str] = None) -> None:
+        phase = {"name": name, "start": start, "duration": duration}
+        if detail:
+            phase["detail"] = detail
+        self.phases.append(phase)
+
+    def mark(self, name: str, since: Optional[float] = None, detail: Optional[str] = None) -> None:
+        # A phase from since (or the start of the request) until now
+        since = self.started_at if since is None else since
+        self.add(name, since, time.monotonic() - since, detail)
+
+    @contextmanager
+    def phase(self, name: str, detail: Optional[str] = None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic() - start, detail)
+
+    def totals(self) -> dict:
+        totals = {}
+        for phase in self.phases:
+            totals[phase["name"]] = totals.get(phase["name"], 0.0) + phase["duration"]
+        return totals
+
+    def summary(self) -> dict:
+        # Milliseconds per phase, plus the time since the request started
+        summary = {name: round(duration * 1000, 1) for name, duration in self.totals().items()}
+        summary["total"] = round((time.monotonic() - self.started_at) * 1000, 1)
+        return summary
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.summary().items())
+
+    def trace(self) -> List[dict]:
+        return [
+            {
+                **phase,
+                "start": round((phase["start"] - self.started_at) * 1000, 1),
+                "duration": round(phase["duration"] * 1000, 1),
+            }
+            for phase in self.phases
+        ]
+
+    def trailer(self) -> dict:
+        trailer = {"server_timing": self.summary()}
+        if self.debug:
+            trailer["debug_trace"] = self.trace()
+        return trailer
+
+
+def start(debug: bool = False) -> RequestTimer:
+    timer = RequestTimer(debug=debug)
+    _current_timer.set(timer)
+    return timer
+
+
+def current() -> Optional[RequestTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def phase(name: str, detail: Optional[str] = None):
+    '''
+    Record a block as a phase of the current request, if it is timed.
+    '''
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name, detail):
+        yield
+
+
+def timed_phase(name: str):
+    '''
+    Decorator recording each call of an async function as a phase of the
+    current request.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with phase(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def with_timing_trailer(r, timer: RequestTimer) -> AsyncGenerator:
+    '''
+    Add the request's timing summary, and its trace in debug mode, to the
+    last event of a stream. It cannot go on a line of its own: the frontend
+    reads history_metadata from the last line. Empty events, which are not
+    sent, pass through right away.
+    '''
+    held = None
+    async for event in r:
+        if not event:
+            yield event
+            continue
+        if held is not None:
+            yield held
+        held = event
+
+    if held is not None:
+        yield {**held, **timer.trailer()}
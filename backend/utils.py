@@ -1,10 +1,28 @@
 import os
+import re
 import json
+import math
+import time
+import asyncio
+import hashlib
 import logging
-import requests
 import dataclasses
+import functools
+import httpx
 
-from typing import List
+from typing import Callable, List, Optional
+
+from backend import metrics, timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -22,6 +40,62 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+SECRET_PARAMS = (
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+    "password",
+)
+
+
+def redact_secrets(obj, secret_params=SECRET_PARAMS):
+    '''
+    Return a copy of obj with the values of secret keys masked, at any depth.
+    '''
+    if isinstance(obj, dict):
+        return {
+            k: "*****" if k in secret_params and v else redact_secrets(v, secret_params)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [redact_secrets(v, secret_params) for v in obj]
+    return obj
+
+
+class RedactedJSON:
+    '''
+    Log argument that renders a payload as indented JSON with secrets masked.
+    Nothing is copied or serialized unless the log record is emitted.
+    '''
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        return json.dumps(redact_secrets(self.payload), indent=4, cls=JSONEncoder)
+
+
+class RedactingLoggerAdapter(logging.LoggerAdapter):
+    '''
+    Logger adapter for request and response bodies. Dict and list arguments
+    are wrapped in RedactedJSON, so they are only serialized, with secrets
+    masked, when the level is enabled.
+    '''
+    def __init__(self, logger=None, extra=None):
+        super().__init__(logger or logging.getLogger(), extra)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            args = tuple(
+                RedactedJSON(arg) if isinstance(arg, (dict, list)) else arg
+                for arg in args
+            )
+            super().log(level, msg, *args, **kwargs)
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
@@ -31,6 +105,396 @@ async def format_as_ndjson(r):
         yield json.dumps({"error": str(error)})
 
 
+def _orjson_default(o):
+    return JSONEncoder().default(o)
+
+
+def fast_json_dumps(obj) -> bytes:
+    '''
+    Compact JSON serializer for hot paths. Uses orjson when it is installed
+    and falls back to the standard library otherwise.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default)
+    return json.dumps(obj, cls=JSONEncoder, separators=(",", ":")).encode("utf-8")
+
+
+class NDJSONStreamEncoder:
+    '''
+    Encodes streamed chat events as NDJSON lines.
+
+    The history_metadata and apim-request-id fields are the same for every
+    event of a response, so they are serialized once and spliced into each
+    line. Empty events are dropped.
+    '''
+    ENVELOPE_KEYS = ("history_metadata", "apim-request-id")
+
+    def __init__(self, dumps: Callable[[object], bytes] = fast_json_dumps):
+        self.dumps = dumps
+        self._envelope_source = None
+        self._envelope = b""
+
+    def _get_envelope(self, event: dict) -> Optional[bytes]:
+        source = tuple(event.get(k) for k in self.ENVELOPE_KEYS)
+        if self._envelope_source is None or any(
+            a is not b for a, b in zip(source, self._envelope_source)
+        ):
+            self._envelope_source = source
+            self._envelope = b"".join(
+                b',"' + k.encode() + b'":' + self.dumps(event[k])
+                for k in self.ENVELOPE_KEYS
+                if k in event
+            )
+        return self._envelope
+
+    def encode(self, event: dict) -> bytes:
+        if not event:
+            return b""
+
+        if "history_metadata" not in event:
+            return self.dumps(event) + b"\n"
+
+        envelope = self._get_envelope(event)
+        body = self.dumps({
+            k: v for k, v in event.items() if k not in self.ENVELOPE_KEYS
+        })
+        if body == b"{}":
+            return b"{" + envelope[1:] + b"}\n"
+        return body[:-1] + envelope + b"}\n"
+
+
+def _get_coalescable_content(event: dict) -> Optional[str]:
+    # Only plain assistant content deltas can be merged into one line
+    try:
+        messages = event["choices"][0]["messages"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+    if len(messages) != 1 or set(messages[0]) != {"role", "content"}:
+        return None
+    if messages[0]["role"] != "assistant" or not isinstance(messages[0]["content"], str):
+        return None
+    return messages[0]["content"]
+
+
+def _merge_content(event: dict, content: str) -> dict:
+    merged = dict(event)
+    merged["choices"] = [{"messages": [{"role": "assistant", "content": content}]}]
+    return merged
+
+
+async def format_stream_as_ndjson(
+    r,
+    coalesce_window_ms: int = 0,
+    coalesce_max_bytes: int = 0,
+    encoder: Optional[NDJSONStreamEncoder] = None,
+):
+    '''
+    Fast NDJSON encoding of a chat event stream.
+
+    With a coalescing window, consecutive assistant content deltas for the
+    same message that arrive within coalesce_window_ms of the first one (and
+    total at most coalesce_max_bytes, if set) are merged into one line.
+    '''
+    encoder = encoder or NDJSONStreamEncoder()
+    encode = encoder.encode
+    encode_seconds = 0.0
+    if metrics.is_enabled():
+        def encode(event):
+            nonlocal encode_seconds
+            start = time.perf_counter()
+            line = encoder.encode(event)
+            encode_seconds += time.perf_counter() - start
+            return line
+
+    if coalesce_window_ms <= 0:
+        try:
+            async for event in r:
+                line = encode(event)
+                if line:
+                    yield line
+        except Exception as error:
+            logging.exception("Exception while generating response stream: %s", error)
+            yield json.dumps({"error": str(error)})
+        finally:
+            metrics.NDJSON_ENCODE_SECONDS.observe(encode_seconds)
+        return
+
+    window = coalesce_window_ms / 1000
+    queue = asyncio.Queue(maxsize=256)
+    end_of_stream = object()
+
+    async def pump():
+        # Reads the upstream events so that the encoder can wait on them
+        # with a timeout without cancelling the upstream iterator
+        try:
+            async for event in r:
+                await queue.put(event)
+            await queue.put(end_of_stream)
+        except Exception as error:
+            await queue.put(error)
+
+    pump_task = asyncio.ensure_future(pump())
+    buffered = None
+    buffered_content = []
+    buffered_bytes = 0
+    deadline = 0.0
+
+    def flush():
+        nonlocal buffered, buffered_content, buffered_bytes
+        line = encode(_merge_content(buffered, "".join(buffered_content)))
+        buffered, buffered_content, buffered_bytes = None, [], 0
+        return line
+
+    try:
+        while True:
+            try:
+                event = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if buffered is None:
+                    event = await queue.get()
+                else:
+                    try:
+                        event = await asyncio.wait_for(
+                            queue.get(), max(0.0, deadline - time.monotonic())
+                        )
+                    except asyncio.TimeoutError:
+                        yield flush()
+                        continue
+
+            if event is end_of_stream:
+                break
+            if isinstance(event, Exception):
+                raise event
+
+            content = _get_coalescable_content(event)
+            if buffered is not None and (
+                content is None
+                or event.get("id") != buffered.get("id")
+                or event.get("history_metadata") is not buffered.get("history_metadata")
+                or event.keys() != buffered.keys()
+            ):
+                yield flush()
+
+            if content is None:
+                line = encode(event)
+                if line:
+                    yield line
+                continue
+
+            if buffered is None:
+                buffered = event
+                deadline = time.monotonic() + window
+            buffered_content.append(content)
+            buffered_bytes += len(content)
+            if coalesce_max_bytes and buffered_bytes >= coalesce_max_bytes:
+                yield flush()
+            elif time.monotonic() >= deadline:
+                yield flush()
+
+        if buffered is not None:
+            yield flush()
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        if buffered is not None:
+            yield flush()
+        yield json.dumps({"error": str(error)})
+    finally:
+        pump_task.cancel()
+        # Let the pump unwind before the upstream streams are closed
+        await asyncio.gather(pump_task, return_exceptions=True)
+        metrics.NDJSON_ENCODE_SECONDS.observe(encode_seconds)
+
+
+async def with_late_history_metadata(r, late_history_metadata, timeout: float):
+    '''
+    Hold back the last event that carries history_metadata until
+    late_history_metadata (an awaitable returning a dict) is ready, then
+    yield it with those fields merged in. The frontend reads history_metadata
+    from the last line of the stream, so that is where late fields must go.
+    The first such event is never held, so the time to first token is not
+    delayed; a stream with only one keeps its original fields. Events after
+    the held one are held too, so the order is kept. Waits at most timeout
+    seconds once the stream has ended; the awaitable itself is never
+    cancelled.
+    '''
+    seen_first = False
+    held = None
+    held_after = []
+    try:
+        async for event in r:
+            if event and "history_metadata" in event:
+                if not seen_first:
+                    seen_first = True
+                    yield event
+                    continue
+                if held is not None:
+                    yield held
+                    for later_event in held_after:
+                        yield later_event
+                    held_after = []
+                held = event
+            elif held is not None:
+                held_after.append(event)
+            else:
+                yield event
+    except Exception:
+        if held is not None:
+            yield held
+            for later_event in held_after:
+                yield later_event
+        raise
+
+    if held is not None:
+        yield await merge_late_history_metadata(held, late_history_metadata, timeout)
+        for later_event in held_after:
+            yield later_event
+
+
+async def merge_late_history_metadata(response: dict, late_history_metadata, timeout: float) -> dict:
+    '''
+    Return a copy of response whose history_metadata includes the fields
+    late_history_metadata resolves to, or response unchanged if they are not
+    ready within timeout seconds or fail.
+    '''
+    try:
+        late = await asyncio.wait_for(asyncio.shield(late_history_metadata), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("History metadata was not ready %ss after the response ended", timeout)
+        return response
+    except Exception:
+        logging.exception("Exception while waiting for history metadata")
+        return response
+
+    if not late:
+        return response
+    response = dict(response)
+    response["history_metadata"] = {**response.get("history_metadata", {}), **late}
+    return response
+
+
+# Fewest UTF-8 bytes per token with the GPT tokenizers, for most text. Estimates
+# based on it err towards too many tokens, so a budget is never overrun.
+BYTES_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text.encode("utf-8")) / BYTES_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    return text.encode("utf-8")[: max_tokens * BYTES_PER_TOKEN].decode("utf-8", errors="ignore")
+
+
+_warned_token_estimate = False
+
+
+def _estimating_token_counts(reason: str) -> Callable[[str], int]:
+    global _warned_token_estimate
+    if not _warned_token_estimate:
+        _warned_token_estimate = True
+        logging.warning("%s, estimating token counts from the text size", reason)
+    return estimate_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(model: str) -> Callable[[str], int]:
+    '''
+    Token counting function for model, using its tiktoken encoding
+    (cl100k_base for names tiktoken does not know, such as deployment
+    names). Falls back to estimate_tokens, with a warning, when tiktoken
+    or its encoding cannot be loaded.
+    Built once per model.
+    '''
+    if tiktoken is None:
+        return _estimating_token_counts("tiktoken is not installed")
+
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return _estimating_token_counts(f"Could not load a tiktoken encoding for {model}")
+
+    def count_tokens(text: str) -> int:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return count_tokens
+
+
+TITLE_STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just let me more most my myself no nor not now of off on once only or
+other our ours ourselves out over own please same she should so some such than that the their theirs them themselves
+then there these they this those through to too under until up very was we were what when where which while who whom
+why will with would you your yours yourself yourselves tell give show explain help want need know like get make could
+can't don't i'm i've it's what's
+""".split())
+
+_TITLE_SENTENCE_SPLIT = re.compile(r"[.!?,;:\n\t()\[\]{}\"]+")
+_TITLE_WORD = re.compile(r"[\w'-]+")
+
+
+def heuristic_title(text: str, max_words: int = 4) -> str:
+    '''
+    Local extractive title for a message: the highest scoring keyword
+    phrases (runs of words between stopwords and punctuation, scored as in
+    RAKE by word degree over frequency), kept in their original order and
+    cut to max_words words.
+    '''
+    phrases = []
+    for sentence in _TITLE_SENTENCE_SPLIT.split(text):
+        phrase = []
+        for word in _TITLE_WORD.findall(sentence):
+            if word.lower() in TITLE_STOPWORDS or word.isdigit() and len(word) < 3:
+                if phrase:
+                    phrases.append(phrase)
+                phrase = []
+            else:
+                phrase.append(word)
+        if phrase:
+            phrases.append(phrase)
+
+    if not phrases:
+        return " ".join(text.split()[:max_words])
+
+    frequency = {}
+    degree = {}
+    for phrase in phrases:
+        for word in phrase:
+            key = word.lower()
+            frequency[key] = frequency.get(key, 0) + 1
+            degree[key] = degree.get(key, 0) + len(phrase)
+
+    def score(phrase):
+        return sum(degree[word.lower()] / frequency[word.lower()] for word in phrase)
+
+    ranked = sorted(range(len(phrases)), key=lambda i: score(phrases[i]), reverse=True)
+    chosen = set()
+    seen = set()
+    remaining = max_words
+    for i in ranked:
+        key = " ".join(phrases[i]).lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        if len(phrases[i]) > remaining:
+            if not chosen:
+                phrases[i] = phrases[i][:remaining]
+                chosen.add(i)
+            continue
+        chosen.add(i)
+        remaining -= len(phrases[i])
+        if remaining == 0:
+            break
+
+    words = [word for i in sorted(chosen) for word in phrases[i]]
+    title = " ".join(words)
+    return title[:1].upper() + title[1:]
+
+
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
         return columns.split("|")
@@ -38,38 +502,78 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+GRAPH_USER_GROUPS_ENDPOINT = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
 
-    headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+_graph_client: Optional[httpx.AsyncClient] = None
+
+
+def get_graph_client() -> httpx.AsyncClient:
+    # Shared connection pool for Microsoft Graph calls
+    global _graph_client
+    if _graph_client is None or _graph_client.is_closed:
+        _graph_client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _graph_client
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
 
-        return r["value"]
+async def close_graph_client():
+    global _graph_client
+    if _graph_client is not None:
+        await _graph_client.aclose()
+        _graph_client = None
+
+
+def get_user_cache_key(userToken: str, principalId: Optional[str] = None) -> str:
+    # Key per-user caches on the principal id authenticated by App Service
+    # (X-Ms-Client-Principal-Id), so that a refreshed token for the same user
+    # still hits the cache. Claims decoded from the token itself are not
+    # verified and must not be trusted. Without a principal id, the whole
+    # token is the key.
+    return hashlib.sha256((principalId or userToken).encode("utf-8")).hexdigest()
+
+
+async def fetchUserGroups(userToken):
+    # Fetch group membership, following @odata.nextLink until all pages are read.
+    # Returns None if the lookup failed.
+    endpoint = GRAPH_USER_GROUPS_ENDPOINT
+    headers = {"Authorization": "bearer " + userToken}
+    userGroups = []
+    try:
+        client = get_graph_client()
+        while endpoint:
+            r = await client.get(endpoint, headers=headers)
+            if r.status_code != 200:
+                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return None
+
+            r = r.json()
+            userGroups.extend(r["value"])
+            endpoint = r.get("@odata.nextLink")
+
+        return userGroups
     except Exception as e:
         logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+        return None
 
 
-def generateFilterString(userToken):
+@metrics.timed(metrics.GRAPH_FILTER_SECONDS, span_name="generateFilterString")
+@timing.timed_phase("graph_filter")
+async def generateFilterString(userToken, userGroupsCache=None, principalId=None):
     # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    if userGroupsCache is not None:
+        userGroups = await userGroupsCache.get_or_set(
+            get_user_cache_key(userToken, principalId),
+            lambda: fetchUserGroups(userToken)
+        )
+    else:
+        userGroups = await fetchUserGroups(userToken)
 
     # Construct filter string
     if not userGroups:
         logging.debug("No user groups found")
+        userGroups = []
 
     group_ids = ", ".join([obj["id"] for obj in userGroups])
     return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
@@ -190,20 +694,54 @@ def format_pf_non_streaming_response(
         return {}
 
 
-def convert_to_pf_format(input_json, request_field_name, response_field_name):
+def format_pf_stream_response(
+    chatCompletionChunk, history_metadata, response_field_name, citations_field_name, message_uuid=None
+):
+    if "error" in chatCompletionChunk:
+        logging.error(f"Error in promptflow response api: {chatCompletionChunk['error']}")
+        raise Exception(chatCompletionChunk["error"])
+
+    response_obj = {
+        "id": message_uuid,
+        "model": "",
+        "created": "",
+        "object": "",
+        "choices": [{"messages": []}],
+        "history_metadata": history_metadata,
+    }
+
+    messages = response_obj["choices"][0]["messages"]
+    if chatCompletionChunk.get(citations_field_name):
+        citation_content = {"citations": chatCompletionChunk[citations_field_name]}
+        messages.append({
+            "role": "tool",
+            "content": json.dumps(citation_content)
+        })
+    if chatCompletionChunk.get(response_field_name):
+        messages.append({
+            "role": "assistant",
+            "content": chatCompletionChunk[response_field_name]
+        })
+
+    if messages:
+        return response_obj
+
+    return {}
+
+
+def convert_to_pf_format(chat_request, request_field_name, response_field_name):
     output_json = []
-    logging.debug(f"Input json: {input_json}")
-    # align the input json to the format expected by promptflow chat flow
-    for message in input_json["messages"]:
-        if message:
-            if message["role"] == "user":
-                new_obj = {
-                    "inputs": {request_field_name: message["content"]},
-                    "outputs": {response_field_name: ""},
-                }
-                output_json.append(new_obj)
-            elif message["role"] == "assistant" and len(output_json) > 0:
-                output_json[-1]["outputs"][response_field_name] = message["content"]
+    logging.debug(f"Input messages: {chat_request.messages}")
+    # align the request messages to the format expected by promptflow chat flow
+    for message in chat_request.messages:
+        if message.role == "user":
+            new_obj = {
+                "inputs": {request_field_name: message.content},
+                "outputs": {response_field_name: ""},
+            }
+            output_json.append(new_obj)
+        elif message.role == "assistant" and len(output_json) > 0:
+            output_json[-1]["outputs"][response_field_name] = message.content
     logging.debug(f"PF formatted response: {output_json}")
     return output_json
 
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import multiprocessing
 
 max_requests = 1000
@@ -11,3 +14,22 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# Workers record their metrics in files in this directory, so that /metrics
+# reports every worker whichever one serves the scrape
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus_multiproc")
+)
+
+
+def on_starting(server):
+    # Start from empty metrics; files of a previous run would be added up
+    multiproc_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drop the gauges of a worker that exited, e.g. after max_requests
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,42 @@
+import pytest
+from backend.admission import AdmissionController, AdmissionRejectedError
+
+
+def test_in_flight_cap():
+    admission = AdmissionController(max_in_flight=1)
+    release = admission.admit("user")
+    with pytest.raises(AdmissionRejectedError) as e:
+        admission.admit("other")
+    assert e.value.reason == "in_flight"
+    assert e.value.retry_after_header == "1"
+
+    release()
+    release()
+    assert admission.in_flight == 0
+    admission.admit("other")
+    assert admission.stats()["rejected"]["in_flight"] == 1
+
+
+def test_user_rate():
+    admission = AdmissionController(user_requests_per_minute=60, user_burst=2)
+    admission.admit("user")
+    admission.admit("user")
+    with pytest.raises(AdmissionRejectedError) as e:
+        admission.admit("user")
+    assert e.value.reason == "user_rate"
+    assert 0 < e.value.retry_after <= 1
+    admission.admit("other")
+
+
+def test_token_budget_gives_back_user_token():
+    admission = AdmissionController(user_requests_per_minute=60, user_burst=1, tokens_per_minute=1000)
+    admission.admit("user", estimated_tokens=800)
+    with pytest.raises(AdmissionRejectedError) as e:
+        admission.admit("other", estimated_tokens=800)
+    assert e.value.reason == "token_budget"
+    assert e.value.retry_after > 1
+
+    # The rejected request did not use up the user's request budget
+    with pytest.raises(AdmissionRejectedError) as e:
+        admission.admit("other", estimated_tokens=800)
+    assert e.value.reason == "token_budget"
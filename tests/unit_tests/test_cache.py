@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from backend.cache import TTLCache
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    cache._entries["a"] = (0, 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_get_or_set_single_flight():
+    cache = TTLCache(maxsize=2, ttl=60)
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return ["group"]
+
+    results = await asyncio.gather(*(cache.get_or_set("user", factory) for _ in range(5)))
+    assert results == [["group"]] * 5
+    assert await cache.get_or_set("user", factory) == ["group"]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_get_or_set_does_not_cache_none():
+    cache = TTLCache(maxsize=2, ttl=60)
+
+    async def factory():
+        return None
+
+    assert await cache.get_or_set("user", factory) is None
+    assert len(cache) == 0
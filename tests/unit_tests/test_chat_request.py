@@ -0,0 +1,66 @@
+import json
+import pytest
+from pydantic import ValidationError
+from backend.chat_request import ChatRequest
+
+
+def test_to_openai_messages():
+    context = {"citations": [{"title": "doc"}]}
+    chat_request = ChatRequest.model_validate_json(json.dumps({
+        "conversation_id": "1",
+        "messages": [
+            {"id": "1", "role": "user", "content": "question", "date": "2024-01-01"},
+            {"id": "2", "role": "tool", "content": json.dumps(context)},
+            {"id": "3", "role": "assistant", "content": "answer", "context": json.dumps(context)},
+            None,
+            {"id": "4", "role": "user", "content": "follow up"},
+        ],
+    }))
+
+    assert chat_request.conversation_id == "1"
+    assert chat_request.history_metadata == {}
+    assert chat_request.messages[-1].id == "4"
+    assert chat_request.to_openai_messages() == [
+        {"role": "user", "content": "question"},
+        {"role": "assistant", "content": "answer", "context": context},
+        {"role": "user", "content": "follow up"},
+    ]
+
+
+def test_invalid_request():
+    with pytest.raises(ValidationError):
+        ChatRequest.model_validate_json('{"messages": "not a list"}')
+
+    with pytest.raises(ValidationError):
+        ChatRequest.model_validate_json('{"messages": [{"content": "no role"}]}')
+
+
+def test_trim_history():
+    context = json.dumps({"citations": [{"content": "x" * 400}]})
+    messages = []
+    for turn in range(5):
+        messages.append({"role": "user", "content": f"question {turn}"})
+        messages.append({"role": "tool", "content": context})
+        messages.append({"role": "assistant", "content": "a" * 40, "context": context})
+    messages.append({"role": "user", "content": "latest"})
+    chat_request = ChatRequest.model_validate({"messages": messages})
+
+    def count_tokens(text):
+        return len(text)
+
+    kept, before, after = chat_request.trim_history(150, count_tokens, contexts_to_keep=0)
+    assert [message.content for message in kept] == [
+        "question 3", "a" * 40, "question 4", "a" * 40, "latest"
+    ]
+    assert after <= 150 < before
+    assert "context" not in chat_request.to_openai_messages(kept, contexts_to_keep=0)[1]
+
+    # The latest turn is kept even when it is over the budget
+    kept, _, _ = chat_request.trim_history(1, count_tokens)
+    assert [message.content for message in kept] == ["latest"]
+
+    kept, before, after = chat_request.trim_history(10000, count_tokens, contexts_to_keep=1)
+    assert len(kept) == 11 and before == after
+    openai_messages = chat_request.to_openai_messages(kept, contexts_to_keep=1)
+    assert [("context" in message) for message in openai_messages].count(True) == 1
+    assert "context" in openai_messages[-2]
@@ -0,0 +1,210 @@
+import pytest
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import (
+    RECOMMENDED_COMPOSITE_INDEXES,
+    CosmosConversationClient,
+    decode_cursor,
+    encode_cursor,
+)
+
+
+class FakePages:
+    def __init__(self, items, page_size, continuation_token):
+        self.items = items
+        self.page_size = page_size
+        self.token = continuation_token
+        self.continuation_token = None
+
+    async def __aiter__(self):
+        if self.token is not None and not self.token.isdigit():
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Invalid continuation token")
+        self.start = int(self.token or 0)
+        end = self.start + self.page_size
+        self.continuation_token = str(end) if end < len(self.items) else None
+        yield FakeQuery(self.items[self.start:end])
+
+
+class FakeQuery:
+    def __init__(self, items, page_size=None):
+        self.items = items
+        self.page_size = page_size
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+
+    def by_page(self, continuation_token=None):
+        return FakePages(self.items, self.page_size, continuation_token)
+
+
+class FakeContainer:
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+
+    def query_items(self, query, parameters, partition_key=None, max_item_count=None, response_hook=None):
+        self.calls.append(query)
+        conversations = sorted(
+            (item for item in self.items.values() if item.get("type") == "conversation"),
+            key=lambda item: item["updatedAt"],
+            reverse=True,
+        )
+        return FakeQuery(conversations, max_item_count)
+
+    async def upsert_item(self, body, response_hook=None):
+        self.calls.append("upsert_item")
+        self.items[(body["userId"], body["id"])] = body
+        return body
+
+    async def read_item(self, item, partition_key, response_hook=None):
+        self.calls.append("read_item")
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError()
+        return self.items[(partition_key, item)]
+
+    async def patch_item(self, item, partition_key, patch_operations, response_hook=None):
+        self.calls.append("patch_item")
+        return self.items[(partition_key, item)]
+
+    async def delete_item(self, item, partition_key, response_hook=None):
+        self.calls.append("delete_item")
+        self.items.pop((partition_key, item), None)
+
+
+def make_client(**kwargs):
+    client = CosmosConversationClient("https://localhost:8081/", "a2V5", "db", "conversations", **kwargs)
+    client.container_client = FakeContainer()
+    return client
+
+
+@pytest.fixture
+def write_behind_client():
+    return make_client(conversation_write_behind_seconds=60)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_message_skips_read_of_known_conversation(write_behind_client):
+    container = write_behind_client.container_client
+    conversation = await write_behind_client.create_conversation("user", "title")
+    container.calls.clear()
+
+    message = {"role": "user", "content": "Hello"}
+    await write_behind_client.create_message("m1", conversation["id"], "user", message)
+    await write_behind_client.create_message("m2", conversation["id"], "user", message)
+    assert container.calls == ["upsert_item", "upsert_item"]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_message_checks_unknown_conversation(write_behind_client):
+    container = write_behind_client.container_client
+    container.items[("user", "c")] = {"id": "c", "userId": "user", "type": "conversation"}
+
+    message = {"role": "user", "content": "Hello"}
+    await write_behind_client.create_message("m1", "c", "user", message)
+    await write_behind_client.create_message("m2", "c", "user", message)
+    assert container.calls == ["read_item", "upsert_item", "upsert_item"]
+
+    await write_behind_client.delete_conversation("user", "c")
+    container.calls.clear()
+    assert await write_behind_client.create_message("m3", "c", "user", message) == "Conversation not found"
+    assert container.calls == ["read_item"]
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_cursors_are_dropped_on_change():
+    client = make_client()
+    container = client.container_client
+    for i in range(5):
+        container.items[("user", str(i))] = {"id": str(i), "userId": "user", "type": "conversation", "updatedAt": str(i)}
+
+    first, _ = await client.get_conversations_page("user", 2)
+    assert [c["id"] for c in first] == ["4", "3"]
+    container.calls.clear()
+    second, _ = await client.get_conversations_page("user", 2, offset=2)
+    assert [c["id"] for c in second] == ["2", "1"]
+    assert "offset" not in container.calls[0]
+
+    await client.create_conversation("user")
+    container.calls.clear()
+    await client.get_conversations_page("user", 2, offset=2)
+    assert container.calls[0].endswith(" offset 2 limit 2")
+
+
+def invert(composite_index):
+    return [
+        {**path, "order": "descending" if path["order"] == "ascending" else "ascending"}
+        for path in composite_index
+    ]
+
+
+def test_check_indexing_policy_matches_recommended_policy():
+    client = make_client()
+    report = client.check_indexing_policy({
+        "indexingPolicy": {
+            "compositeIndexes": [RECOMMENDED_COMPOSITE_INDEXES[0], invert(RECOMMENDED_COMPOSITE_INDEXES[1])],
+            "excludedPaths": [{"path": "/content/*"}, {"path": '/"_etag"/?'}],
+        }
+    })
+    assert report == {"missing_composite_indexes": [], "missing_excluded_paths": []}
+    assert client.use_composite_indexes
+
+
+def test_check_indexing_policy_reports_missing_entries():
+    client = make_client()
+    reordered = [RECOMMENDED_COMPOSITE_INDEXES[0][1], RECOMMENDED_COMPOSITE_INDEXES[0][0], RECOMMENDED_COMPOSITE_INDEXES[0][2]]
+    mixed = [*RECOMMENDED_COMPOSITE_INDEXES[1][:2], invert(RECOMMENDED_COMPOSITE_INDEXES[1])[2]]
+    report = client.check_indexing_policy({
+        "indexingPolicy": {
+            "compositeIndexes": [reordered, mixed],
+            "excludedPaths": [{"path": "/content/?"}],
+        }
+    })
+    assert report == {
+        "missing_composite_indexes": RECOMMENDED_COMPOSITE_INDEXES,
+        "missing_excluded_paths": ["/content/*"],
+    }
+    assert not client.use_composite_indexes
+
+    report = client.check_indexing_policy({})
+    assert report["missing_excluded_paths"] == ["/content/?", "/content/*"]
+
+
+def test_order_by_uses_composite_index_only_when_present():
+    client = make_client()
+    assert client._order_by(["userId", "type"], "updatedAt", "DESC") == "c.updatedAt DESC"
+
+    client.check_indexing_policy({"indexingPolicy": {"compositeIndexes": RECOMMENDED_COMPOSITE_INDEXES}})
+    assert client._order_by(["userId", "type"], "updatedAt", "DESC") == "c.userId ASC, c.type ASC, c.updatedAt DESC"
+    assert client._order_by(["userId", "type"], "updatedAt", "ASC") == "c.userId DESC, c.type DESC, c.updatedAt ASC"
+    assert client._order_by(["conversationId", "type"], "createdAt", "ASC") == "c.conversationId ASC, c.type ASC, c.createdAt ASC"
+
+    client.check_indexing_policy({"indexingPolicy": {"compositeIndexes": RECOMMENDED_COMPOSITE_INDEXES[:1]}})
+    assert client._order_by(["userId", "type"], "updatedAt", "DESC") == "c.updatedAt DESC"
+
+
+def test_cursor_round_trip():
+    continuation_token = '[{"compositeToken":"+RID:~abc==#RT:1#TRC:2","orderByItems":[{"item":"2024-05-01T12:00:00"}]}]'
+    cursor = encode_cursor(continuation_token)
+    assert "+" not in cursor and "/" not in cursor
+    assert decode_cursor(cursor) == continuation_token
+
+
+@pytest.mark.parametrize("cursor", [None, 5, "", "not a cursor!", "YWJ", "/w==", "gA"])
+def test_decode_cursor_rejects_malformed_cursors(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+@pytest.mark.asyncio
+async def test_tampered_cursor_is_rejected():
+    client = make_client()
+    container = client.container_client
+    for i in range(3):
+        container.items[("user", str(i))] = {"id": str(i), "userId": "user", "type": "conversation", "updatedAt": str(i)}
+
+    _, next_token = await client.get_conversations_page("user", 2)
+    conversations, _ = await client.get_conversations_page("user", 2, continuation_token=decode_cursor(encode_cursor(next_token)))
+    assert [c["id"] for c in conversations] == ["0"]
+
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        await client.get_conversations_page("user", 2, continuation_token=next_token + "x")
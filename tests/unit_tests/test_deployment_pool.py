@@ -0,0 +1,70 @@
+import httpx
+import openai
+import pytest
+from types import SimpleNamespace
+from backend.deployment_pool import Deployment, DeploymentPool
+from backend.retry import RetryPolicy
+
+
+class FakeClient:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.models = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=self.create)
+        ))
+
+    async def create(self, model, timeout=None, **kwargs):
+        self.models.append(model)
+        response = httpx.Response(
+            self.status_code, headers=self.headers, request=httpx.Request("POST", "https://example.com")
+        )
+        if self.status_code != 200:
+            raise openai.APIStatusError("error", response=response, body=None)
+        return response
+
+    async def close(self):
+        pass
+
+
+def pool(*clients, weights=None):
+    deployments = [
+        Deployment(client, model=f"deployment-{i}", weight=(weights or [1] * len(clients))[i])
+        for i, client in enumerate(clients)
+    ]
+    return DeploymentPool(deployments, RetryPolicy(max_retries=1, base_delay=0.01, max_delay=0.02), default_model="chat")
+
+
+@pytest.mark.asyncio
+async def test_fails_over_on_throttling():
+    throttled = FakeClient(429, {"retry-after": "30"})
+    healthy = FakeClient(headers={"x-ratelimit-remaining-tokens": "500"})
+    deployment_pool = pool(throttled, healthy)
+    deployment_pool.deployments[1].outstanding = 5
+
+    for _ in range(3):
+        await deployment_pool.create({"model": "chat", "messages": []})
+
+    assert throttled.models == ["deployment-0"]
+    assert healthy.models == ["deployment-1"] * 3
+    assert deployment_pool.deployments[0].breaker.state == "open"
+    assert deployment_pool.deployments[1].remaining_tokens == 500
+
+
+@pytest.mark.asyncio
+async def test_other_models_are_sent_unchanged():
+    client = FakeClient()
+    await pool(client).create({"model": "title-model", "messages": []})
+    assert client.models == ["title-model"]
+
+
+def test_select_prefers_least_outstanding_and_quota():
+    deployment_pool = pool(FakeClient(), FakeClient(), weights=[1, 3])
+    busy, roomy = deployment_pool.deployments
+    busy.outstanding, roomy.outstanding = 1, 2
+    assert deployment_pool.select() is roomy
+
+    roomy.update_quota({"x-ratelimit-remaining-tokens": "10"})
+    assert deployment_pool.select(tokens_needed=1000) is busy
+    assert deployment_pool.select(exclude=[busy], tokens_needed=1000) is roomy
@@ -0,0 +1,63 @@
+import pytest
+import prometheus_client
+from backend import metrics
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.configure(enabled=True)
+    yield
+    metrics.configure(enabled=False)
+
+
+def sample(name, **labels):
+    return prometheus_client.REGISTRY.get_sample_value(name, labels)
+
+
+def test_render_histogram_with_exemplar(enabled_metrics):
+    histogram = metrics.Histogram("test_latency_seconds", "Test latency.", ["outcome"], buckets=(0.1, 1))
+    histogram.observe(0.05, outcome="ok")
+    histogram.observe(0.5, exemplar={"apim_request_id": "abc"}, outcome="ok")
+
+    assert sample("test_latency_seconds_bucket", outcome="ok", le="0.1") == 1
+    assert sample("test_latency_seconds_bucket", outcome="ok", le="1.0") == 2
+    assert sample("test_latency_seconds_count", outcome="ok") == 2
+
+    body, content_type = metrics.render(openmetrics=True)
+    assert content_type.startswith("application/openmetrics-text")
+    assert b'test_latency_seconds_bucket{le="1.0",outcome="ok"} 2.0 # {apim_request_id="abc"} 0.5 ' in body
+    assert body.endswith(b"# EOF\n")
+
+
+def test_counters_have_total_suffix(enabled_metrics):
+    metrics.ADMISSION_REJECTED.inc(reason="user_rate")
+    metrics.PROMPT_CACHE_LOOKUPS.inc(result="hit")
+
+    body, content_type = metrics.render()
+    assert content_type.startswith("text/plain")
+    assert b"# TYPE admission_rejected_total counter" in body
+    assert sample("admission_rejected_total", reason="user_rate") >= 1
+    assert sample("prompt_cache_lookups_total", result="hit") >= 1
+
+
+def test_disabled_metrics_are_not_recorded():
+    counter = metrics.Counter("test_disabled", "Test.")
+    counter.inc()
+    assert sample("test_disabled_total") == 0
+
+
+@pytest.mark.asyncio
+async def test_timed(enabled_metrics):
+    histogram = metrics.Histogram("test_operation_seconds", "Test.", ["operation", "outcome"])
+
+    @metrics.timed(histogram, operation="read")
+    async def operation(fail):
+        if fail:
+            raise ValueError()
+        return "ok"
+
+    assert await operation(False) == "ok"
+    with pytest.raises(ValueError):
+        await operation(True)
+    assert sample("test_operation_seconds_count", operation="read", outcome="ok") == 1
+    assert sample("test_operation_seconds_count", operation="read", outcome="error") == 1
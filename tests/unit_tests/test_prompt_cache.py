@@ -0,0 +1,60 @@
+import pytest
+from backend.prompt_cache import (
+    PromptCache,
+    MemoryPromptCacheBackend,
+    SqlitePromptCacheBackend,
+    prompt_cache_key,
+)
+
+
+def model_args(key="secret", **kwargs):
+    args = {
+        "messages": [{"role": "user", "content": "question"}],
+        "temperature": 0,
+        "seed": 42,
+        "stream": True,
+        "user": None,
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {
+            "index_name": "index", "authentication": {"type": "api_key", "key": key}
+        }}]},
+    }
+    args.update(kwargs)
+    return args
+
+
+def response(content):
+    return {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": content}]}], "history_metadata": {"title": "t"}}
+
+
+def test_prompt_cache_key():
+    key = prompt_cache_key(model_args())
+    assert key == prompt_cache_key(model_args(key="rotated", stream=False))
+    assert key != prompt_cache_key(model_args(messages=[{"role": "user", "content": "other"}]))
+    assert prompt_cache_key(model_args(temperature=0.7)) is None
+    assert prompt_cache_key(model_args(seed=None)) is None
+
+
+@pytest.mark.asyncio
+async def test_prompt_cache_counters():
+    cache = PromptCache(MemoryPromptCacheBackend(max_entries=2, ttl=60))
+    assert await cache.get("a") is None
+    await cache.set("a", response("answer"))
+    assert await cache.get("a") == {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": "answer"}]}]}
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+@pytest.mark.asyncio
+async def test_sqlite_backend_is_shared_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = SqlitePromptCacheBackend(path, max_entries=2, ttl=60)
+    second = SqlitePromptCacheBackend(path, max_entries=2, ttl=60)
+
+    await first.set("a", {"content": "a"})
+    await first.set("b", {"content": "b"})
+    assert await second.get("a") == {"content": "a"}
+    await second.set("c", {"content": "c"})
+    assert await first.get("b") is None
+    assert await first.get("a") == {"content": "a"}
+
+    await first.close()
+    await second.close()
@@ -0,0 +1,52 @@
+import pytest
+from backend.response_cache import ResponseCache, normalize_question, record_stream, replay_cached_response
+
+
+def model_args(question, filter=None, history=()):
+    parameters = {"index_name": "index"}
+    if filter:
+        parameters["filter"] = filter
+    return {
+        "messages": [{"role": "system", "content": "system"}, *history, {"role": "user", "content": question}],
+        "temperature": 0,
+        "model": "gpt",
+        "stream": True,
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": parameters}]},
+    }
+
+
+def test_normalize_question():
+    assert normalize_question("  What is the PTO policy? ") == normalize_question("what is the pto  policy")
+
+
+def test_cache_key():
+    cache = ResponseCache()
+    key = cache.key(model_args("What is the PTO policy?", filter="group_ids/any(g:search.in(g, 'a'))"))
+
+    assert key == cache.key(model_args("what is the pto policy", filter="group_ids/any(g:search.in(g, 'a'))"))
+    assert key != cache.key(model_args("what is the pto policy", filter="group_ids/any(g:search.in(g, 'b'))"))
+    assert key != cache.key(model_args("what is the pto policy"))
+    assert cache.key(model_args("what is the pto policy", history=[
+        {"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}
+    ])) is None
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay_stream():
+    cache = ResponseCache()
+    key = cache.key(model_args("question"))
+
+    async def events():
+        for message in ({"role": "tool", "content": "{}"}, {"role": "assistant", "content": "an"}):
+            yield {"id": "1", "model": "gpt", "created": 1, "choices": [{"messages": [message]}]}
+        yield {"id": "1", "model": "gpt", "created": 1, "choices": [{"messages": [{"role": "assistant", "content": "swer"}]}]}
+
+    async def store(result):
+        cache.set(key, result)
+
+    assert len([event async for event in record_stream(events(), store)]) == 3
+    replayed = [event async for event in replay_cached_response(cache.get(key), {"conversation_id": "c"})]
+    assert [event["choices"][0]["messages"][0] for event in replayed] == [
+        {"role": "tool", "content": "{}"}, {"role": "assistant", "content": "answer"}
+    ]
+    assert replayed[-1]["history_metadata"] == {"conversation_id": "c"}
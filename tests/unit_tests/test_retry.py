@@ -0,0 +1,83 @@
+import httpx
+import openai
+import pytest
+from backend.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, get_retry_after
+
+
+def api_error(status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "https://example.com"))
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def test_get_retry_after():
+    assert get_retry_after({"retry-after-ms": "250", "retry-after": "3"}) == 0.25
+    assert get_retry_after({"retry-after": "3"}) == 3
+    assert get_retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert get_retry_after({}) is None
+
+
+@pytest.mark.asyncio
+async def test_retries_transient_errors():
+    errors = [api_error(429, {"retry-after-ms": "10"}), api_error(503)]
+    timeouts = []
+
+    async def attempt(timeout):
+        timeouts.append(timeout)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    policy = RetryPolicy(max_retries=3, base_delay=0.01, max_delay=0.05, deadline=10)
+    assert await policy.call(attempt) == "ok"
+    assert len(timeouts) == 3
+    assert all(0 < timeout <= 10 for timeout in timeouts)
+
+
+@pytest.mark.asyncio
+async def test_does_not_retry_client_errors_or_past_the_deadline():
+    calls = 0
+
+    async def bad_request(timeout):
+        nonlocal calls
+        calls += 1
+        raise api_error(400)
+
+    with pytest.raises(openai.APIStatusError):
+        await RetryPolicy(base_delay=0.01).call(bad_request)
+    assert calls == 1
+
+    async def throttled(timeout):
+        nonlocal calls
+        calls += 1
+        raise api_error(429, {"retry-after": "60"})
+
+    calls = 0
+    with pytest.raises(openai.APIStatusError):
+        await RetryPolicy(base_delay=0.01, deadline=5).call(throttled)
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    async def unavailable(timeout):
+        raise api_error(500)
+
+    policy = RetryPolicy(max_retries=1, base_delay=0.01, max_delay=0.02)
+    with pytest.raises(openai.APIStatusError):
+        await policy.call(unavailable, breaker=breaker)
+    assert breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError) as e:
+        await policy.call(unavailable, breaker=breaker)
+    assert e.value.retry_after_header == "30"
+
+    breaker.blocked_until = 0
+    assert breaker.state == "half_open"
+
+    async def ok(timeout):
+        return "ok"
+
+    assert await policy.call(ok, breaker=breaker) == "ok"
+    assert breaker.state == "closed"
@@ -36,7 +36,8 @@ def test_dotenv_no_datasource_2(app_settings):
     assert app_settings.azure_openai is not None
 
     
-def test_dotenv_with_azure_search_success(app_settings):
+@pytest.mark.asyncio
+async def test_dotenv_with_azure_search_success(app_settings):
     # Validate model object
     assert app_settings.search is not None
     assert app_settings.base_settings.datasource_type == "AzureCognitiveSearch"
@@ -45,14 +46,21 @@ def test_dotenv_with_azure_search_success(app_settings):
     assert app_settings.azure_openai is not None
     
     # Validate API payload structure
-    payload = app_settings.datasource.construct_payload_configuration()
+    payload = await app_settings.datasource.construct_payload_configuration()
     assert payload["type"] == "azure_search"
     assert payload["parameters"] is not None
     assert payload["parameters"]["endpoint"] == "https://search_service.search.windows.net"
     print(payload)
 
+    # The request-independent template is reused, per-request fields are not
+    payload["parameters"]["filter"] = "group_ids/any(g:search.in(g, 'group'))"
+    second_payload = await app_settings.datasource.construct_payload_configuration()
+    assert "filter" not in second_payload["parameters"]
+    assert second_payload["parameters"]["endpoint"] == payload["parameters"]["endpoint"]
 
-def test_dotenv_with_elasticsearch_success(app_settings):
+
+@pytest.mark.asyncio
+async def test_dotenv_with_elasticsearch_success(app_settings):
     # Validate model object
     assert app_settings.search is not None
     assert app_settings.base_settings.datasource_type == "Elasticsearch"
@@ -61,7 +69,7 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     assert app_settings.azure_openai is not None
     
     # Validate API payload structure
-    payload = app_settings.datasource.construct_payload_configuration()
+    payload = await app_settings.datasource.construct_payload_configuration()
     assert payload["type"] == "elasticsearch"
     assert payload["parameters"] is not None
     assert payload["parameters"]["endpoint"] == "dummy"
@@ -70,3 +78,15 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+
+
+def test_dotenv_deployments_only(app_settings):
+    # AZURE_OPENAI_DEPLOYMENTS replaces AZURE_OPENAI_ENDPOINT
+    assert app_settings.azure_openai.endpoint is None
+    deployments = app_settings.azure_openai.get_deployments()
+    assert [deployment.base_url for deployment in deployments] == [
+        "https://east.openai.azure.com/",
+        "https://west.openai.azure.com/",
+    ]
+    assert deployments[0].weight == 2
+    assert deployments[1].model == "west_model"
@@ -0,0 +1,93 @@
+import json
+import contextvars
+
+import pytest
+from backend import timing
+from backend.utils import format_stream_as_ndjson
+
+
+def test_phases_add_up_in_header():
+    timer = timing.RequestTimer()
+    timer.add("cosmos.create_message", timer.started_at, 0.010)
+    timer.add("cosmos.create_message", timer.started_at + 0.01, 0.005)
+    timer.add("upstream", timer.started_at + 0.02, 0.250, detail="eastus/gpt-4")
+
+    summary = timer.summary()
+    assert summary["cosmos.create_message"] == 15.0
+    assert summary["upstream"] == 250.0
+    assert "total" in summary
+    assert timer.header().startswith("cosmos.create_message;dur=15.0, upstream;dur=250.0, total;dur=")
+
+    trace = timer.trace()
+    assert [phase["name"] for phase in trace] == ["cosmos.create_message", "cosmos.create_message", "upstream"]
+    assert trace[2] == {"name": "upstream", "start": 20.0, "duration": 250.0, "detail": "eastus/gpt-4"}
+
+
+def test_trailer_includes_trace_in_debug_mode():
+    assert "debug_trace" not in timing.RequestTimer().trailer()
+    assert "debug_trace" in timing.RequestTimer(debug=True).trailer()
+
+
+def test_phase_without_timer_is_a_no_op():
+    def run():
+        with timing.phase("auth"):
+            pass
+        return timing.current()
+
+    assert contextvars.copy_context().run(run) is None
+
+
+@pytest.mark.asyncio
+async def test_timed_phase_records_on_current_timer():
+    @timing.timed_phase("graph_filter")
+    async def build_filter():
+        return "filter"
+
+    async def run():
+        timer = timing.start()
+        assert await build_filter() == "filter"
+        return timer
+
+    timer = await contextvars.copy_context().run(run)
+    assert [phase["name"] for phase in timer.phases] == ["graph_filter"]
+
+
+async def _events(events):
+    for event in events:
+        yield event
+
+
+@pytest.mark.asyncio
+async def test_trailer_goes_on_last_sent_event():
+    timer = timing.RequestTimer()
+    events = [
+        {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": "Hel"}]}]},
+        {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": "lo"}]}]},
+        {},
+    ]
+
+    result = [event async for event in timing.with_timing_trailer(_events(events), timer)]
+    assert result[0] == events[0]
+    assert result[1] == {}
+    assert result[2]["choices"] == events[1]["choices"]
+    assert "total" in result[2]["server_timing"]
+
+
+@pytest.mark.asyncio
+async def test_trailer_is_not_lost_when_coalescing():
+    timer = timing.RequestTimer()
+    history_metadata = {"conversation_id": "c"}
+    events = [
+        {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": c}]}], "history_metadata": history_metadata}
+        for c in ("Hel", "lo", "!")
+    ]
+
+    lines = [
+        json.loads(line)
+        async for line in format_stream_as_ndjson(
+            timing.with_timing_trailer(_events(events), timer), coalesce_window_ms=1000
+        )
+    ]
+    assert [line["choices"][0]["messages"][0]["content"] for line in lines] == ["Hello", "!"]
+    assert "server_timing" in lines[-1]
+    assert lines[-1]["history_metadata"] == history_metadata
@@ -1,5 +1,22 @@
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+import asyncio
+import base64
+import json
+import logging
+from backend import utils
+from backend.utils import (
+    RedactingLoggerAdapter,
+    estimate_tokens,
+    format_as_ndjson,
+    format_pf_stream_response,
+    format_stream_as_ndjson,
+    get_user_cache_key,
+    heuristic_title,
+    parse_multi_columns,
+    redact_secrets,
+    truncate_to_tokens,
+    with_late_history_metadata,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +44,212 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def test_format_pf_stream_response():
+    chunk = {"reply": "Hello", "documents": [{"title": "doc"}]}
+    response = format_pf_stream_response(chunk, {"conversation_id": "1"}, "reply", "documents", "msg-1")
+    assert response["id"] == "msg-1"
+    assert response["history_metadata"] == {"conversation_id": "1"}
+    assert response["choices"][0]["messages"] == [
+        {"role": "tool", "content": '{"citations": [{"title": "doc"}]}'},
+        {"role": "assistant", "content": "Hello"},
+    ]
+    assert format_pf_stream_response({"reply": ""}, {}, "reply", "documents") == {}
+
+
+def test_get_user_cache_key():
+    def make_token(claims):
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+        return f"header.{payload}.signature"
+
+    first_token = make_token({"oid": "user-1", "exp": 1})
+    refreshed_token = make_token({"oid": "user-1", "exp": 2})
+    assert get_user_cache_key(first_token, "principal-1") == get_user_cache_key(refreshed_token, "principal-1")
+    assert "principal-1" not in get_user_cache_key(first_token, "principal-1")
+    assert get_user_cache_key("not-a-jwt") == get_user_cache_key("not-a-jwt")
+
+
+def test_get_user_cache_key_ignores_token_claims():
+    def make_token(claims):
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+        return f"header.{payload}.signature"
+
+    # A forged token carrying another user's oid must not get their entry
+    victim_token = make_token({"oid": "user-1", "exp": 1})
+    forged_token = make_token({"oid": "user-1", "exp": 2, "forged": True})
+    assert get_user_cache_key(victim_token, "principal-1") != get_user_cache_key(forged_token, "principal-2")
+    assert get_user_cache_key(victim_token) != get_user_cache_key(forged_token)
+
+
+def test_estimate_tokens_overcounts():
+    assert estimate_tokens("Hello world") == 4
+    assert estimate_tokens("日本語") == 3
+    truncated = truncate_to_tokens("日本語のテキスト", 2)
+    assert truncated == "日本"
+    assert estimate_tokens(truncated) <= 2
+
+
+def test_token_counter_fallback_warns_once(monkeypatch, caplog):
+    monkeypatch.setattr(utils, "tiktoken", None)
+    monkeypatch.setattr(utils, "_warned_token_estimate", False)
+    utils.get_token_counter.cache_clear()
+    try:
+        with caplog.at_level(logging.WARNING):
+            assert utils.get_token_counter("gpt-4") is estimate_tokens
+            assert utils.get_token_counter("gpt-4o") is estimate_tokens
+    finally:
+        utils.get_token_counter.cache_clear()
+    assert [record.getMessage() for record in caplog.records] == [
+        "tiktoken is not installed, estimating token counts from the text size"
+    ]
+
+
+def test_redact_secrets():
+    payload = {
+        "messages": [{"role": "user", "content": "hi"}],
+        "extra_body": {
+            "data_sources": [{
+                "parameters": {
+                    "key": "secret",
+                    "authentication": {"type": "api_key", "key": "secret"},
+                    "embedding_dependency": {"authentication": {"key": "secret"}},
+                }
+            }]
+        },
+    }
+    redacted = redact_secrets(payload)
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+    assert parameters["key"] == "*****"
+    assert parameters["authentication"] == {"type": "api_key", "key": "*****"}
+    assert parameters["embedding_dependency"]["authentication"]["key"] == "*****"
+    assert redacted["messages"] == payload["messages"]
+    assert payload["extra_body"]["data_sources"][0]["parameters"]["key"] == "secret"
+
+
+def test_redacting_logger_adapter(caplog):
+    class Unserializable(dict):
+        def items(self):
+            raise AssertionError("payload should not be serialized")
+
+    logger = RedactingLoggerAdapter(logging.getLogger("test_redacting_logger_adapter"))
+    with caplog.at_level(logging.INFO, logger="test_redacting_logger_adapter"):
+        logger.debug("REQUEST BODY: %s", Unserializable())
+    assert caplog.records == []
+
+    with caplog.at_level(logging.DEBUG, logger="test_redacting_logger_adapter"):
+        logger.debug("REQUEST BODY: %s", {"api_key": "secret"})
+    assert "secret" not in caplog.text
+    assert '"api_key": "*****"' in caplog.text
+
+
+def make_stream_event(content, history_metadata):
+    return {
+        "id": "chatcmpl-1",
+        "model": "gpt",
+        "created": 1,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [{"role": "assistant", "content": content}]}],
+        "history_metadata": history_metadata,
+        "apim-request-id": "apim-1",
+    }
+
+
+@pytest.mark.asyncio
+async def test_format_stream_as_ndjson():
+    history_metadata = {"conversation_id": "1"}
+    events = [
+        make_stream_event("Hel", history_metadata),
+        {},
+        make_stream_event("lo", history_metadata),
+    ]
+
+    async def dummy_generator():
+        for event in events:
+            yield event
+
+    lines = [line async for line in format_stream_as_ndjson(dummy_generator())]
+    assert len(lines) == 2
+    assert all(line.endswith(b"\n") for line in lines)
+    assert [json.loads(line) for line in lines] == [events[0], events[2]]
+
+
+@pytest.mark.asyncio
+async def test_format_stream_as_ndjson_coalesce():
+    history_metadata = {"conversation_id": "1"}
+    tool_event = make_stream_event("", history_metadata)
+    tool_event["choices"][0]["messages"] = [{"role": "tool", "content": "{}"}]
+
+    async def dummy_generator():
+        yield tool_event
+        for content in ["a", "b", "c", "d"]:
+            yield make_stream_event(content, history_metadata)
+
+    lines = [
+        json.loads(line)
+        async for line in format_stream_as_ndjson(
+            dummy_generator(), coalesce_window_ms=1000, coalesce_max_bytes=3
+        )
+    ]
+    assert [line["choices"][0]["messages"][0]["content"] for line in lines] == ["{}", "abc", "d"]
+    assert lines[1]["history_metadata"] == history_metadata
+    assert lines[1]["apim-request-id"] == "apim-1"
+
+
+@pytest.mark.asyncio
+async def test_format_stream_as_ndjson_coalesce_exception():
+    async def dummy_generator():
+        yield make_stream_event("partial", {})
+        raise Exception("test exception")
+
+    lines = [
+        line async for line in format_stream_as_ndjson(dummy_generator(), coalesce_window_ms=1000)
+    ]
+    assert json.loads(lines[0])["choices"][0]["messages"][0]["content"] == "partial"
+    assert lines[1] == '{"error": "test exception"}'
+
+
+@pytest.mark.asyncio
+async def test_with_late_history_metadata():
+    history_metadata = {"conversation_id": "1", "title": "placeholder"}
+    title = asyncio.get_running_loop().create_future()
+
+    events = []
+
+    async def dummy_generator():
+        yield make_stream_event("a", history_metadata)
+        # The first event is sent before the next one is produced
+        assert len(events) == 1
+        yield {}
+        yield make_stream_event("b", history_metadata)
+        title.set_result({"title": "Generated"})
+        yield {}
+
+    async for event in with_late_history_metadata(dummy_generator(), title, 1):
+        events.append(event)
+    assert [event.get("history_metadata", {}).get("title") for event in events] == [
+        "placeholder", None, "Generated", None
+    ]
+    assert events[0]["choices"][0]["messages"][0]["content"] == "a"
+    assert events[2]["choices"][0]["messages"][0]["content"] == "b"
+    assert history_metadata["title"] == "placeholder"
+
+
+@pytest.mark.asyncio
+async def test_with_late_history_metadata_timeout():
+    title = asyncio.get_running_loop().create_future()
+
+    async def dummy_generator():
+        yield make_stream_event("a", {"title": "placeholder"})
+        yield make_stream_event("b", {"title": "placeholder"})
+
+    events = [event async for event in with_late_history_metadata(dummy_generator(), title, 0.01)]
+    assert [event["history_metadata"]["title"] for event in events] == ["placeholder", "placeholder"]
+    assert not title.cancelled()
+
+
+def test_heuristic_title():
+    assert heuristic_title("How do I reset my Azure OpenAI API key in the portal?") == "Azure OpenAI API key"
+    assert heuristic_title("What is the weather like today?") == "Weather today"
+    assert len(heuristic_title("Summarize the quarterly revenue report for Contoso and list the main risks", 3).split()) <= 3
+    assert heuristic_title("2+2?") == "2+2?"
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of turning a /conversation request body into model messages.
+
+Compares the previous dict pipeline (filter tool messages into a new list in
+send_chat_request, then rebuild every message and decode every citation
+context in prepare_model_args) with parsing and validating the raw body
+once into a ChatRequest and building the messages in a single pass. Reports
+time and the peak memory allocated per request, measured with tracemalloc.
+
+Usage:
+    python tools/benchmarks/chat_request.py [--turns 50] [--iterations 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.chat_request import ChatRequest  # noqa: E402
+
+
+def make_body(turns):
+    context = json.dumps({
+        "citations": [
+            {"content": "lorem ipsum " * 200, "title": f"doc{i}", "url": f"https://example.com/{i}"}
+            for i in range(5)
+        ]
+    })
+    messages = []
+    for turn in range(turns):
+        messages.append({"id": f"u{turn}", "role": "user", "content": "question " * 20, "date": "2024-01-01"})
+        messages.append({"id": f"t{turn}", "role": "tool", "content": context, "date": "2024-01-01"})
+        messages.append({"id": f"a{turn}", "role": "assistant", "content": "answer " * 80, "context": context, "date": "2024-01-01"})
+    return json.dumps({"messages": messages}).encode()
+
+
+def dict_pipeline(raw):
+    request_body = json.loads(raw)
+
+    filtered_messages = []
+    for message in request_body.get("messages", []):
+        if message.get("role") != "tool":
+            filtered_messages.append(message)
+    request_body["messages"] = filtered_messages
+
+    messages = []
+    for message in request_body.get("messages", []):
+        if message:
+            if message["role"] == "assistant" and "context" in message:
+                messages.append({
+                    "role": message["role"],
+                    "content": message["content"],
+                    "context": json.loads(message["context"]),
+                })
+            else:
+                messages.append({"role": message["role"], "content": message["content"]})
+    return messages
+
+
+def model_pipeline(raw):
+    return ChatRequest.model_validate_json(raw).to_openai_messages()
+
+
+def measure(pipeline, raw, iterations):
+    assert pipeline(raw)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        pipeline(raw)
+    elapsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    pipeline(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak - before
+
+
+def main(turns, iterations):
+    raw = make_body(turns)
+    assert dict_pipeline(raw) == model_pipeline(raw)
+
+    print(f"request body: {len(raw) / 1024:.0f} KiB, {turns} turns")
+    for name, pipeline in (("dict pipeline", dict_pipeline), ("ChatRequest", model_pipeline)):
+        elapsed, peak = measure(pipeline, raw, iterations)
+        print(f"{name:14} {elapsed * 1e3:8.3f} ms/request  peak {peak / 1024:8.0f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    main(args.turns, args.iterations)
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the per-request cost of building the data source payload.
+
+Compares rebuilding the payload from the settings models on every request
+(model_dump of the data source and search settings, which is what
+construct_payload_configuration used to do) with overlaying the request on
+the precomputed payload template.
+
+Usage:
+    python tools/benchmarks/datasource_payload.py [--iterations 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+os.environ.setdefault("AZURE_OPENAI_MODEL", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com/")
+os.environ.setdefault("AZURE_OPENAI_EMBEDDING_NAME", "benchmark-embedding")
+os.environ.setdefault("DATASOURCE_TYPE", "AzureCognitiveSearch")
+os.environ.setdefault("AZURE_SEARCH_SERVICE", "benchmark")
+os.environ.setdefault("AZURE_SEARCH_INDEX", "benchmark")
+os.environ.setdefault("AZURE_SEARCH_KEY", "benchmark")
+os.environ.setdefault("AZURE_SEARCH_CONTENT_COLUMNS", "content|chunk")
+os.environ.setdefault("AZURE_SEARCH_VECTOR_COLUMNS", "contentVector")
+
+from backend.settings import app_settings  # noqa: E402
+
+
+async def main(iterations):
+    datasource = app_settings.datasource
+    if datasource is None:
+        raise SystemExit("No data source is configured")
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        datasource.construct_payload_template()
+    rebuild = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await datasource.construct_payload_configuration()
+    template = (time.perf_counter() - start) / iterations
+
+    print(f"data source: {app_settings.base_settings.datasource_type}")
+    print(f"rebuild per request:  {rebuild * 1e6:8.2f} us")
+    print(f"template per request: {template * 1e6:8.2f} us")
+    print(f"speedup:              {rebuild / template:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
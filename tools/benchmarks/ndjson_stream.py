@@ -0,0 +1,87 @@
+"""
+Benchmark serialization throughput of a streamed chat answer.
+
+Builds the chunks of a simulated 2,000-token streamed answer and measures
+how fast they are turned into NDJSON lines by format_stream_response with
+format_as_ndjson (the original per-token json.dumps), by the
+NDJSONStreamEncoder used by format_stream_as_ndjson, and by the encoder
+with delta coalescing enabled.
+
+Usage:
+    python tools/benchmarks/ndjson_stream.py [--tokens 2000] [--repeat 20]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.utils import (  # noqa: E402
+    format_as_ndjson,
+    format_stream_as_ndjson,
+    format_stream_response,
+    orjson,
+)
+
+
+def make_chunks(tokens):
+    return [
+        SimpleNamespace(
+            id="chatcmpl-benchmark",
+            model="gpt-4",
+            created=1700000000,
+            object="chat.completion.chunk",
+            choices=[SimpleNamespace(delta=SimpleNamespace(role="assistant", content=f" token{i}"))],
+        )
+        for i in range(tokens)
+    ]
+
+
+async def run(label, tokens, repeat, encode):
+    chunks = make_chunks(tokens)
+    history_metadata = {
+        "conversation_id": "6a1d9b5e-3f0c-4a59-9b39-2c2f1f0f9d7e",
+        "title": "Benchmark conversation",
+        "date": "2024-01-01T00:00:00",
+    }
+
+    async def events():
+        for chunk in chunks:
+            yield format_stream_response(chunk, history_metadata, "apim-benchmark")
+
+    lines = 0
+    size = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        async for line in encode(events()):
+            lines += 1
+            size += len(line)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{label:<28} tokens/s={tokens * repeat / elapsed:>10.0f} "
+        f"lines/answer={lines // repeat:<6} bytes/answer={size // repeat}"
+    )
+
+
+async def main(tokens, repeat):
+    print(f"json backend: {'orjson' if orjson else 'json'}")
+    await run("format_as_ndjson", tokens, repeat, format_as_ndjson)
+    await run("format_stream_as_ndjson", tokens, repeat, format_stream_as_ndjson)
+    await run(
+        "coalesced (256 bytes)",
+        tokens,
+        repeat,
+        lambda r: format_stream_as_ndjson(r, coalesce_window_ms=50, coalesce_max_bytes=256),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.tokens, args.repeat))
@@ -0,0 +1,150 @@
+"""
+Benchmark connection reuse of the Azure OpenAI client.
+
+Starts a local mock chat completions endpoint and sends the same number of
+requests through (a) a new client per request, which is how the app used to
+behave, and (b) the single pooled client created by init_openai_client().
+The mock endpoint counts accepted TCP connections so the difference in
+connection reuse is visible alongside the wall clock time.
+
+Usage:
+    python tools/benchmarks/openai_client_pool.py [--requests 1000] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+HOST = "127.0.0.1"
+PORT = int(os.environ.get("BENCHMARK_MOCK_PORT", "8765"))
+
+os.environ.setdefault("AZURE_OPENAI_MODEL", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_KEY", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", f"http://{HOST}:{PORT}/")
+
+import httpx  # noqa: E402
+from openai import AsyncAzureOpenAI  # noqa: E402
+
+from app import init_openai_client, USER_AGENT  # noqa: E402
+from backend.settings import app_settings  # noqa: E402
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-benchmark",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "benchmark",
+    "choices": [{
+        "index": 0,
+        "finish_reason": "stop",
+        "message": {"role": "assistant", "content": "Hello"},
+    }],
+}).encode()
+
+
+class MockEndpoint:
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                content_length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        content_length = int(line.split(b":", 1)[1])
+                if content_length:
+                    await reader.readexactly(content_length)
+                self.requests += 1
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"apim-request-id: benchmark\r\n"
+                    + f"Content-Length: {len(COMPLETION)}\r\n\r\n".encode()
+                    + COMPLETION
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+def per_request_client():
+    return AsyncAzureOpenAI(
+        api_version=app_settings.azure_openai.preview_api_version,
+        api_key=app_settings.azure_openai.key,
+        default_headers={"x-ms-useragent": USER_AGENT},
+        azure_endpoint=app_settings.azure_openai.endpoint,
+        http_client=httpx.AsyncClient(),
+    )
+
+
+async def send(client):
+    raw_response = await client.chat.completions.with_raw_response.create(
+        model=app_settings.azure_openai.model,
+        messages=[{"role": "user", "content": "Hi"}],
+    )
+    raw_response.parse()
+
+
+async def run(label, total, concurrency, get_client, release_client):
+    endpoint = MockEndpoint()
+    server = await asyncio.start_server(endpoint.handle, HOST, PORT)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            client = await get_client()
+            try:
+                await send(client)
+            finally:
+                await release_client(client)
+
+    async with server:
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{label:<20} requests={endpoint.requests:<6} "
+        f"connections={endpoint.connections:<6} "
+        f"elapsed={elapsed:.2f}s req/s={total / elapsed:.0f}"
+    )
+
+
+async def main(total, concurrency):
+    async def new_client():
+        return per_request_client()
+
+    async def close_client(client):
+        await client.close()
+
+    await run("per-request client", total, concurrency, new_client, close_client)
+
+    pooled = await init_openai_client()
+
+    async def shared_client():
+        return pooled
+
+    async def keep_client(client):
+        pass
+
+    try:
+        await run("pooled client", total, concurrency, shared_client, keep_client)
+    finally:
+        await pooled.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))